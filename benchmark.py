@@ -0,0 +1,365 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from collections import Counter
+import pandas as pd
+from datetime import datetime, timedelta
+
+import task1
+import black_model
+
+
+# synthetic broker feed, modelled on the layouts of hycdx_option_quotes_*.txt
+
+
+def _strikes(random_state, ref_px, count, step):
+    top = round((ref_px + step * count / 2) / step) * step
+    return [top - step * i for i in range(count)]
+
+
+def _price_pair(random_state, value, width, digits):
+    if value < 0:
+        return '--', '--'
+    return '{:.{}f}'.format(value, digits), '{:.{}f}'.format(value + width, digits)
+
+
+def _message_xxx(random_state, sent, ref_px, expiries):
+    lines = ['From: XXX At: {} UTC-5:00'.format(sent.strftime('%m/%d/%y %H:%M:%S')),
+             'To:  ',
+             'Subject: HY37 5y SWAPTION UPDATE - Ref {:g} ({:.2f})'.format(
+                 ref_px, random_state.uniform(300, 350)),
+             '',
+             'Assume Option phys settled Bilat or ICE as specified PRIOR trade, same for delta']
+    for expiry in expiries:
+        lines.append('Expiry {} ({:.2f} {:.2f})'.format(expiry.strftime('%d%b%y'),
+                                                        ref_px - random_state.uniform(0, 2), random_state.uniform(300, 350)))
+        lines.append(
+            'Stk   Sprd  |     Pay      Delta       Rec      Vol   Vol Chg  Vol Bpd  Tail  |')
+        for strike in _strikes(random_state, ref_px, random_state.randint(8, 14), 0.5):
+            pay = _price_pair(random_state, random_state.choice(
+                [-1, random_state.uniform(0, 4)]), 0.15, 3)
+            rec = _price_pair(random_state, random_state.choice(
+                [-1, random_state.uniform(0, 8)]), 0.15, 3)
+            lines.append('{:5.1f} {:5.1f} | {:>5}/{:<5}  {:5.1f}   {:>5}/{:<5} {:5.1f}   {:4.1f}     {:4.1f}   {:5.1f}  |'.format(
+                strike, random_state.uniform(250, 500), pay[0], pay[1], -random_state.uniform(1, 99.9),
+                rec[0], rec[1], random_state.uniform(30, 100), random_state.uniform(-1, 8),
+                random_state.uniform(5, 20), random_state.uniform(1, 99.9)))
+        lines.append('')
+    return lines
+
+
+def _message_yyy(random_state, sent, ref_px, expiries):
+    subject = '$$ CDX OPTIONS: HY37 5Y UPDATE - REF {:g}'.format(ref_px)
+    lines = ['From: YYY At: {} UTC-5:00'.format(sent.strftime('%m/%d/%y %H:%M:%S')),
+             'To:  ', 'Subject: ' + subject, '', subject, '']
+    for expiry in expiries:
+        month = expiry.strftime('%b%y').upper()
+        lines.append('EXPIRY: {} Fwd {:.2f} / {:.1f} Dv01 {:.2f}'.format(expiry.strftime('%d-%b-%Y').upper(),
+                                                                        ref_px - random_state.uniform(0, 2), random_state.uniform(300, 350), random_state.uniform(4, 5)))
+        lines.append(
+            ' K [~Sprd]  |{0}>PAY   Dlt |{0}>RCV   Dlt |MidVol [SprdVol] Chg    b/e'.format(month))
+        lines.append('')
+        for strike in _strikes(random_state, ref_px, random_state.randint(8, 14), 0.5):
+            pay, rec = random_state.uniform(0, 300), random_state.uniform(0, 300)
+            delta = random_state.randint(1, 99)
+            lines.append('{:.1f} [{:3d}] |{:5.1f} {:<5.1f} {:2d}% |{:5.1f} {:<5.1f} {:2d}% |{:5.1f}% [{:3d}%]    {:+.1f}% {:5.2f}'.format(
+                strike, random_state.randint(250, 500), pay, pay + 15, delta, rec, rec + 15, 100 - delta,
+                random_state.uniform(4, 10), random_state.randint(30, 70), random_state.uniform(-2, 2), random_state.uniform(5, 13)))
+            lines.append('')
+        lines.append('')
+    return lines
+
+
+def _message_zzz(random_state, sent, ref_px, expiries):
+    # ZZZ pads its columns with runs of UTF-8 non-breaking spaces
+    nbsp = '\xa0'
+    lines = ['From: ZZZ At: {} UTC-5:00'.format(sent.strftime('%m/%d/%y %H:%M:%S')),
+             'To:  ', 'Subject: Options: HY37 5Y', '', '']
+    for expiry in expiries:
+        lines.append('Exp: {} Swaptions Ref: {:g}{}CDX HY37'.format(
+            expiry.strftime('%d-%b-%y'), ref_px, nbsp * 4))
+        lines.append(nbsp * 4 + 'K' + nbsp * 4 + '|' + nbsp * 5 + 'Puts' + nbsp * 4 + 'Del' + nbsp + '|' + nbsp * 4 + 'Calls' +
+                     nbsp * 4 + 'Del' + nbsp + '|' + nbsp * 3 + 'Vol' + nbsp * 4 + 'Chg' + nbsp + '|' + nbsp * 2 + 'Prc' + nbsp + 'Vol')
+        for strike in _strikes(random_state, ref_px, random_state.randint(4, 24), 0.25):
+            put, call = random_state.randint(20, 200), random_state.randint(20, 500)
+            delta = random_state.randint(1, 99)
+            # '_' stands for a non-breaking space, the strike is right aligned with them too
+            row = '{:_>8}_|___{}_/__{}___{}_|___{}_/__{}__{}_|__{:.1f}___{:+.1f} |____{:.1f} '.format(
+                '{:g}'.format(strike), put, put + 18, delta, call, call + 18, delta - 100,
+                random_state.uniform(35, 65), random_state.uniform(0, 6), random_state.uniform(5, 10))
+            lines.append(row.replace('_', nbsp))
+        lines.append('')
+    return lines
+
+
+def _message_www(random_state, sent, ref_px, expiries):
+    subject = 'CDX Options: CDX.HY S37/36 5Y Dec-Jun [ref {:g}] - Update'.format(
+        ref_px)
+    lines = ['From: WWW At: {} UTC-5:00'.format(sent.strftime('%m/%d/%y %H:%M:%S')),
+             'To:  ', 'Subject: ' + subject, '', subject, ' ', '',
+             'The prices are indicative. The mid is the arithmetic mean of the market.',
+             'Please contact your sales coverage for further pricing.', ' ']
+    for expiry in expiries:
+        lines.append('CDX Options: HY (S37V1) {} ** Fwd @{:.3f}, Delta @{:g}'.format(
+            expiry.strftime('%d-%b-%y'), ref_px - random_state.uniform(0, 2), ref_px))
+        lines.append(' ')
+        lines.append(
+            '  K  |     Rec     Delta Vol  Chg B/E|   K  |     Pay     Delta Vol  Chg  B/E')
+        calls = _strikes(random_state, ref_px + 2, random_state.randint(6, 10), 0.5)
+        puts = _strikes(random_state, ref_px, len(
+            calls) + random_state.randint(0, 6), 0.5)
+        for i, put_strike in enumerate(puts):
+            put = random_state.uniform(0, 150)
+            put_side = '{:^6}| {:>5.1f}/{:<5.1f}  {:2d}%   {:2d} {:4.1f} {:4.1f}'.format(
+                '{:g}'.format(put_strike), put, put + 16, random_state.randint(1, 99), random_state.randint(30, 80),
+                random_state.uniform(-1, 1), random_state.uniform(5, 16))
+            if i < len(calls):
+                call = random_state.uniform(0, 150)
+                lines.append('{:^5}| {:>5.1f}/{:<5.1f}  {:2d}%   {:2d} {:4.1f} {:3.1f}|'.format(
+                    '{:g}'.format(calls[i]), call, call + 16, random_state.randint(0, 99), random_state.randint(30, 80),
+                    random_state.uniform(-1, 1), random_state.uniform(5, 9.9)) + put_side)
+            else:
+                # WWW quotes more puts than calls, the missing calls are dashes
+                lines.append('  -  |     -       -    -    -   - |' + put_side)
+        lines.append(' ')
+    return lines
+
+
+_message_writers = [_message_xxx, _message_yyy, _message_zzz, _message_www]
+
+
+def generate_feed(path, lines, seed=0):
+    """Write a file of about the given number of lines of random XXX/YYY/ZZZ/WWW messages, returns {firm: lines}"""
+    random_state = random.Random(seed)
+    sent = datetime(2021, 11, 29, 8, 0, 0)
+    expiries = [datetime(2021, 12, 15), datetime(2022, 1, 19), datetime(2022, 2, 16),
+                datetime(2022, 3, 16), datetime(2022, 4, 20), datetime(2022, 6, 15)]
+    written = Counter()
+    with open(path, 'w', encoding='utf-8') as file:
+        while sum(written.values()) < lines:
+            sent += timedelta(seconds=random_state.randint(1, 120))
+            message = random_state.choice(_message_writers)(random_state, sent, round(random_state.uniform(106, 110) * 8) / 8,
+                                                            expiries[:random_state.randint(2, len(expiries))])
+            message = ['', ''] + message
+            file.write('\n'.join(message) + '\n')
+            written[message[2].split()[1]] += len(message)
+    return dict(written)
+
+
+# correctness against task1_output_expected.xlsx
+
+
+# rows of task1_output_expected.xlsx the parser covers per firm, the check fails when one drops
+EXPECTED_COVERAGE = {'XXX': 196, 'YYY': 232, 'WWW': 110, 'ZZZ': 0}
+
+def _comparable_rows(df):
+    df = df.rename(columns={'Implied Vol bps': 'Implied Vol Bps'})
+    columns = ['Date', 'Time', 'Firm', 'Expiration', 'Option Type', 'Strike Px', 'Strike Spd', 'Bid Price',
+               'Ask Price', 'Delta', 'Implied Vol Spd', 'Implied Vol Bps', 'Implied Vol Px', 'Ref Px']
+    df = df[columns].copy()
+    for column in ('Date', 'Expiration'):
+        df[column] = pd.to_datetime(
+            df[column].astype(str), format='mixed').dt.strftime('%Y-%m-%d')
+    if pd.api.types.is_timedelta64_dtype(df['Time']):
+        df['Time'] = (pd.Timestamp(0) + df['Time']).dt.strftime('%H:%M:%S')
+    for column in ('Time', 'Firm', 'Option Type'):
+        df[column] = df[column].astype(str)
+    for column in columns[5:]:
+        df[column] = df[column].astype(float).round(9)
+    # NaN != NaN, so compare missing values as None
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def _sample_paths(directory='.'):
+    return sorted(os.path.join(directory, file) for file in os.listdir(directory)
+                  if file.startswith('hycdx_option_quotes_') and file.endswith('.txt'))
+
+
+def check_expected(directory='.'):
+    """Parse the sample files and compare the rows with the expected workbook
+
+    The parser does not cover every row of the workbook yet, so the check fails when a parsed row is
+    not in the workbook (a changed value) and reports the coverage per firm, to compare with
+    EXPECTED_COVERAGE.
+    """
+    actual = task1.convert_to_dataframe(task1.parse_files(_sample_paths(directory)))
+    expected = pd.read_excel(os.path.join(
+        directory, 'task1_output_expected.xlsx'))
+    remaining = Counter(_comparable_rows(expected))
+    unexpected = []
+    for row in _comparable_rows(actual):
+        if remaining.get(row, 0) > 0:
+            remaining[row] -= 1
+        else:
+            unexpected.append(row)
+    coverage = {}
+    for firm in sorted(expected['Firm'].unique()):
+        coverage[firm] = (int((actual['Firm'] == firm).sum()),
+                          int((expected['Firm'] == firm).sum()))
+    return unexpected, coverage
+
+
+def check_book(price_quotes):
+    """Build a QuoteBook of the quotes and look every latest quote up, returns the quotes the book lost"""
+    book = task1.QuoteBook()
+    book.update(price_quotes)
+    book.rebase(None)
+    latest = {}
+    for quote in price_quotes.to_option_quotes():
+        if quote.strike_px is not None:
+            key = (quote.firm, quote.expiration, quote.option_type, quote.strike_px)
+            if key not in latest or (latest[key].date, latest[key].time) <= (quote.date, quote.time):
+                latest[key] = quote
+    missing = []
+    for (firm, expiration, option_type, strike_px), quote in latest.items():
+        level = book.level(expiration, option_type, strike_px)
+        booked = level.quotes.get(firm) if level is not None else None
+        if booked is None or level not in book.strikes(expiration, option_type, strike_px, strike_px) or \
+                vars(booked[0]) != vars(quote):
+            missing.append(quote)
+    return missing
+
+
+# stage timings
+
+
+def _match_only(text):
+    # classify and match every line without building any quote
+    parent_quotes = [None, None]
+    broker_format = task1._unknown_broker_format
+    matched = 0
+    pos = 0
+    while pos < len(text):
+        line_end = text.find('\n', pos) + 1 or len(text)
+        kind, rule = broker_format.classify(text, pos)
+        matched_line = rule.regex.match(
+            text, pos, line_end) if rule is not None else None
+        if matched_line:
+            matched += 1
+            if kind == 'from':
+                # the firm decides which rules the next lines are classified with
+                parent_quotes[0] = task1._create_company_quote(matched_line)
+                broker_format = task1._broker_format(parent_quotes)
+        pos = line_end
+    return matched
+
+
+def run_stages(path, output_directory, excel=False):
+    """Time each stage of the pipeline on one feed file, returns {stage: seconds}"""
+    timings = {}
+    started = time.perf_counter()
+    with open(path, 'rb') as file:
+        text = task1._decode(file.read())
+    timings['read'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    _match_only(text)
+    timings['match'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    price_quotes = task1.QuoteColumns()
+    price_quotes.flush_size = float('inf')
+    task1.process_option_quote_text(text, [None, None], price_quotes)
+    timings['capture'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    price_quotes.flush()
+    timings['build'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    df = task1.convert_to_dataframe(price_quotes)
+    timings['dataframe'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    book = task1.QuoteBook()
+    book.update(price_quotes)
+    timings['book'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    black_model.analyse_quotes(price_quotes)
+    timings['analytics'] = time.perf_counter() - started
+
+    for output_format in task1.OUTPUT_WRITERS:
+        started = time.perf_counter()
+        task1.write_partitioned(df, os.path.join(
+            output_directory, output_format), output_format)
+        timings['write ' + output_format] = time.perf_counter() - started
+    if excel:
+        started = time.perf_counter()
+        task1.write_excel(df, os.path.join(output_directory, 'quotes.xlsx'))
+        timings['write excel'] = time.perf_counter() - started
+    return timings, len(price_quotes)
+
+
+def peak_memory(path):
+    """Peak traced memory in bytes of parsing a feed file into a DataFrame"""
+    tracemalloc.start()
+    try:
+        price_quotes = task1.QuoteColumns()
+        task1.read_quote_file(path, price_quotes)
+        task1.convert_to_dataframe(price_quotes)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='sizes of the synthetic feeds, up to 10M lines')
+    parser.add_argument('--excel', action='store_true',
+                        help='also time writing an Excel workbook (slow, at most 1M rows)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the separate pass that measures the peak memory')
+    args = parser.parse_args()
+
+    unexpected, coverage = check_expected()
+    dropped = False
+    for firm, (parsed, expected) in coverage.items():
+        print('{}: parsed {} of {} expected rows'.format(firm, parsed, expected))
+        if parsed < EXPECTED_COVERAGE.get(firm, 0):
+            print('  {} covered {} rows before'.format(firm, EXPECTED_COVERAGE[firm]))
+            dropped = True
+    if unexpected:
+        print('{} parsed rows differ from task1_output_expected.xlsx, e.g. {}'.format(
+            len(unexpected), unexpected[0]))
+    if unexpected or dropped:
+        raise SystemExit(1)
+    print('All parsed rows match task1_output_expected.xlsx.')
+    missing = check_book(task1.parse_files(_sample_paths()))
+    if missing:
+        print('{} quotes are missing from the QuoteBook, e.g. {}'.format(len(missing), missing[0]))
+        raise SystemExit(1)
+    print('The QuoteBook holds the latest quote of every firm and option.')
+
+    # the feed has messages of every firm, but the lines of the firms the registry does not parse yet
+    # would only inflate lines/s
+    uncovered = sorted(firm for firm, rows in EXPECTED_COVERAGE.items() if rows == 0)
+    with tempfile.TemporaryDirectory() as directory:
+        for lines in args.lines:
+            path = os.path.join(directory, 'feed_{}.txt'.format(lines))
+            firm_lines = generate_feed(path, lines)
+            lines = sum(firm_lines.values())
+            parsed_lines = lines - sum(firm_lines.get(firm, 0) for firm in uncovered)
+            size = os.path.getsize(path) / 1e6
+            timings, quotes = run_stages(path, os.path.join(directory, 'output_{}'.format(lines)),
+                                         excel=args.excel and lines <= 1000000)
+            parse = timings['read'] + timings['capture'] + \
+                timings['build'] + timings['dataframe']
+            print('\n{:,} lines, {:.1f} MB, {:,} quotes'.format(lines, size, quotes))
+            for stage, seconds in timings.items():
+                print('  {:<14} {:8.3f}s'.format(stage, seconds))
+            print('  parse to DataFrame: {:,.0f} lines/s, {:,.0f} quotes/s'.format(
+                parsed_lines / parse, quotes / parse))
+            if uncovered:
+                print('  {} quotes are not parsed yet, their {:,} lines are not counted in lines/s'.format(
+                    '/'.join(uncovered), lines - parsed_lines))
+            print('  Black model analytics: {:,.0f} options/s'.format(
+                quotes / timings['analytics']))
+            if not args.no_memory:
+                print('  peak memory: {:.1f} MB'.format(peak_memory(path) / 1e6))
+            os.remove(path)
@@ -0,0 +1,161 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr  # pip install scipy
+
+import task1
+
+
+# Black model on the index price: the premium is undiscounted and in points
+
+
+# firms that quote the put delta only, on both sides of a strike
+SINGLE_DELTA_FIRMS = {'XXX'}
+
+
+def black(forward, strike, vol, time_to_expiry, is_call):
+    """Return the price, delta and vega of every option at once"""
+    sign = np.where(is_call, 1.0, -1.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = vol * np.sqrt(time_to_expiry)
+        d1 = (np.log(forward / strike) + 0.5 * deviation * deviation) / deviation
+        d2 = d1 - deviation
+        price = sign * (forward * ndtr(sign * d1) - strike * ndtr(sign * d2))
+        delta = sign * ndtr(sign * d1)
+        vega = forward * np.exp(-0.5 * d1 * d1) / np.sqrt(2 * np.pi) * np.sqrt(time_to_expiry)
+    return price, delta, vega
+
+
+def implied_vol(price, forward, strike, time_to_expiry, is_call, tolerance=1e-10, iterations=100,
+                low=1e-6, high=5.0):
+    """Solve black(...)[0] == price for the vol of every option at once
+
+    Newton steps that leave the bracket [low, high] are replaced by bisection steps, and the bracket
+    shrinks after every step since the price grows with the vol. The vol is NaN where the price is
+    outside the no-arbitrage bounds (below the intrinsic value, above the forward for a call or the
+    strike for a put).
+    """
+    price, forward, strike, time_to_expiry, is_call = np.broadcast_arrays(
+        *(np.asarray(value, dtype=float) for value in (price, forward, strike, time_to_expiry, is_call)))
+    is_call = is_call.astype(bool)
+    intrinsic = np.maximum(np.where(is_call, forward - strike, strike - forward), 0.0)
+    bound = np.where(is_call, forward, strike)
+    vols = np.full(price.shape, np.nan)
+    # only the options that have not converged yet are solved at each step
+    active = np.flatnonzero((price > intrinsic) & (price < bound) & (time_to_expiry > 0))
+    target, forward, strike, time_to_expiry, is_call = (
+        value.ravel()[active] for value in (price, forward, strike, time_to_expiry, is_call))
+    low = np.full(len(active), low)
+    high = np.full(len(active), high)
+    vol = np.full(len(active), 0.2)
+    for _ in range(iterations):
+        if len(active) == 0:
+            break
+        model, _, vega = black(forward, strike, vol, time_to_expiry, is_call)
+        difference = model - target
+        converged = np.abs(difference) < tolerance
+        vols.ravel()[active[converged]] = vol[converged]
+        high = np.where(difference > 0, vol, high)
+        low = np.where(difference < 0, vol, low)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            newton = vol - difference / vega
+        vol = np.where((newton > low) & (newton < high), newton, 0.5 * (low + high))
+        keep = ~converged
+        active, target, forward, strike, time_to_expiry, is_call, low, high, vol = (
+            value[keep] for value in (active, target, forward, strike, time_to_expiry, is_call, low, high, vol))
+    return vols
+
+
+def _chain_slopes(df):
+    """Strike price points per bp of strike spread around every quote, from the neighbouring strikes of its chain"""
+    chains = ['Date', 'Time', 'Firm', 'Expiration', 'Option Type']
+    ordered = df.sort_values(chains + ['Strike Px'])
+    chain = ordered.groupby(chains, observed=True, sort=False).ngroup().to_numpy()
+    strike_px = ordered['Strike Px'].to_numpy()
+    strike_spd = ordered['Strike Spd'].to_numpy()
+    # central differences inside a chain, one-sided ones at its ends
+    previous = np.r_[0, np.arange(len(ordered) - 1)]
+    following = np.r_[np.arange(1, len(ordered)), len(ordered) - 1]
+    previous = np.where(chain[previous] == chain, previous, np.arange(len(ordered)))
+    following = np.where(chain[following] == chain, following, np.arange(len(ordered)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (strike_px[following] - strike_px[previous]) / \
+            (strike_spd[following] - strike_spd[previous])
+    return pd.Series(np.abs(slopes), index=ordered.index).reindex(df.index).to_numpy()
+
+
+def broker_price_vols(df):
+    """The price vol of every quote from what the broker reports
+
+    The price vol (Implied Vol Px, in %) when it is quoted. Otherwise the spread vol (Implied Vol Spd)
+    is converted where the forward spread and the strike spreads are quoted too: a lognormal spread vol s
+    is a price vol of about s * S * |dK/dS| / F at a forward of price F and spread S.
+    """
+    price_vols = df['Implied Vol Px'].to_numpy() / 100
+    spread_vols = df['Implied Vol Spd'].to_numpy() / 100 * df['Fwd Spd'].to_numpy() * \
+        _chain_slopes(df) / df['Fwd Px'].to_numpy()
+    return np.where(np.isnan(price_vols), spread_vols, price_vols)
+
+
+def analyse_quotes(price_quotes, vol_tolerance=0.02, delta_tolerance=0.10):
+    """Return the convert_to_dataframe() table of the quotes with their Black model values and the disagreements
+
+    The forward is the one quoted for the expiry, or the ref px for the firms that do not quote it.
+    Model Vol is the vol implied by the mid price and Model Delta the delta at that vol. Model Price is the
+    price at the broker's vol (see broker_price_vols). The flags are:
+    Bid Ask Flag, the bid is above the ask or the mid has no implied vol;
+    Vol Flag, the broker's price vol is more than vol_tolerance away from Model Vol;
+    Delta Flag, the broker's delta is more than delta_tolerance away from Model Delta. The brokers do not
+    sign their deltas the same way, so only the absolute values are compared, and the call delta of the
+    SINGLE_DELTA_FIRMS is derived from their put delta.
+    """
+    df = task1.convert_to_dataframe(price_quotes)
+    # the forward is parsed but not part of the table
+    arrays = price_quotes.to_arrays()
+    df['Fwd Px'] = arrays['fwd_px']
+    df['Fwd Spd'] = arrays['fwd_spd']
+    # the forward of the expiry where the firm quotes it, the ref px otherwise
+    forward = np.where(np.isnan(arrays['fwd_px']), arrays['ref_px'], arrays['fwd_px'])
+    strike = df['Strike Px'].to_numpy(dtype=float)
+    time_to_expiry = ((df['Expiration'] - df['Date']).dt.days / 365.0).to_numpy()
+    is_call = (df['Option Type'] == 'C').to_numpy()
+    bid = df['Bid Price'].to_numpy(dtype=float)
+    ask = df['Ask Price'].to_numpy(dtype=float)
+
+    model_vols = implied_vol(0.5 * (bid + ask), forward, strike, time_to_expiry, is_call)
+    _, model_deltas, _ = black(forward, strike, model_vols, time_to_expiry, is_call)
+    broker_vols = broker_price_vols(df)
+    model_prices, _, _ = black(forward, strike, broker_vols, time_to_expiry, is_call)
+
+    quoted = ~np.isnan(bid) & ~np.isnan(ask) & ~np.isnan(strike)
+    broker_deltas = np.abs(df['Delta'].to_numpy(dtype=float)) / 100
+    # XXX quotes one (payer) delta per strike, which the parser copies onto the call; the forward delta
+    # of the call is 1 - |put delta|
+    single_delta = df['Firm'].isin(SINGLE_DELTA_FIRMS).to_numpy() & is_call
+    broker_deltas = np.where(single_delta, 1 - broker_deltas, broker_deltas)
+    df = df.assign(**{'Model Vol': model_vols, 'Model Delta': model_deltas,
+                      'Broker Px Vol': broker_vols, 'Model Price': model_prices})
+    df['Bid Ask Flag'] = quoted & ((bid > ask) | np.isnan(model_vols))
+    df['Vol Flag'] = np.abs(broker_vols - model_vols) > vol_tolerance
+    df['Delta Flag'] = np.abs(broker_deltas - np.abs(model_deltas)) > delta_tolerance
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vol-tolerance', type=float, default=0.02,
+                        help='largest difference of price vol between the broker and the model')
+    parser.add_argument('--delta-tolerance', type=float, default=0.10,
+                        help='largest difference of delta between the broker and the model')
+    args = parser.parse_args()
+    paths = sorted(file for file in os.listdir('.')
+                   if file.startswith('hycdx_option_quotes_') and file.endswith('.txt'))
+    price_quotes = task1.parse_files(paths)
+    started = time.perf_counter()
+    df = analyse_quotes(price_quotes, args.vol_tolerance, args.delta_tolerance)
+    seconds = time.perf_counter() - started
+    flags = ['Bid Ask Flag', 'Vol Flag', 'Delta Flag']
+    print(df.groupby('Firm', observed=True)[flags].sum().to_string())
+    print('{:,} options in {:.3f}s, {:,.0f} options/s'.format(len(df), seconds, len(df) / seconds))
@@ -1,8 +1,22 @@
 import os
 import re
-import copy
+import mmap
+import locale
+import json
+import hashlib
+import time
+import random
+import argparse
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from functools import lru_cache
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from math import isnan, nan, inf
 from enum import Enum
 
 
@@ -12,7 +26,7 @@ class OptionType(Enum):
 
 
 class OptionQuote:
-    def __init__(self, date, time, firm, expiration, option_type, strike_px, strike_spd, bid_px, ask_px, delta, implied_vol_spd, implied_vol_bps, implied_vol_px, ref_px):
+    def __init__(self, date, time, firm, expiration, option_type, strike_px, strike_spd, bid_px, ask_px, delta, implied_vol_spd, implied_vol_bps, implied_vol_px, ref_px, fwd_px=None, fwd_spd=None):
         self.date = date
         self.time = time
         self.firm = firm
@@ -27,6 +41,291 @@ class OptionQuote:
         self.implied_vol_bps = implied_vol_bps
         self.implied_vol_px = implied_vol_px
         self.ref_px = ref_px
+        # the forward price and spread of the expiry, for the firms that quote them
+        self.fwd_px = fwd_px
+        self.fwd_spd = fwd_spd
+
+
+class QuoteColumns:
+    """Accumulate option quotes column by column in typed, growable arrays
+
+    Quotes are added in two stages. add_row() only keeps the strings captured from a quote row,
+    flush() then converts all pending strings at once with NumPy.
+    """
+    _float_columns = ('strike_px', 'strike_spd', 'bid_px', 'ask_px', 'delta',
+                      'implied_vol_spd', 'implied_vol_bps', 'implied_vol_px', 'ref_px', 'fwd_px', 'fwd_spd')
+    _epoch = datetime(1970, 1, 1)
+    # pending rows are converted once there are this many, to bound the memory held by the strings
+    flush_size = 65536
+
+    def __init__(self):
+        self.timestamp = array('q')  # seconds since epoch of the email date and time
+        self.expiration = array('q')  # days since epoch
+        self.firm = array('h')  # index into self.firms
+        self.option_type = array('b')  # OptionType value
+        for column in self._float_columns:
+            setattr(self, column, array('d'))
+        self.firms = []
+        self._firm_codes = {}
+        self._count = 0  # number of quotes, converted or pending
+        # every quote of an expiry block shares the same parent quote, so convert its fields once
+        self._parent_quote = None
+        self._blocks = []  # (first row, timestamp, expiration, firm code, (ref, fwd px, fwd spd)) of the pending rows
+        self._pending = {}  # quote row -> (first row numbers, tuples of captured strings)
+
+    def __len__(self):
+        return self._count
+
+    def __getstate__(self):
+        # only converted columns are sent between processes
+        self.flush()
+        return self.__dict__
+
+    def _firm_code(self, firm):
+        firm_code = self._firm_codes.get(firm)
+        if firm_code is None:
+            firm_code = self._firm_codes[firm] = len(self.firms)
+            self.firms.append(firm)
+        return firm_code
+
+    def _start_block(self, contract_quote: OptionQuote):
+        time = contract_quote.time
+        timestamp = (contract_quote.date - self._epoch).days * 86400 + \
+            time.hour * 3600 + time.minute * 60 + time.second
+        expiration = (contract_quote.expiration - self._epoch).days
+        parent_pxs = tuple(nan if value is None else value for value in
+                           (contract_quote.ref_px, contract_quote.fwd_px, contract_quote.fwd_spd))
+        self._parent_quote = contract_quote
+        self._blocks.append((self._count, timestamp, expiration,
+                            self._firm_code(contract_quote.firm), parent_pxs))
+
+    def add_row(self, contract_quote: OptionQuote, quote_row, strings):
+        """Add the options of one quote row (a QuoteRow) given the strings captured for it"""
+        if contract_quote is not self._parent_quote:
+            self._start_block(contract_quote)
+        pending = self._pending.get(quote_row)
+        if pending is None:
+            pending = self._pending[quote_row] = (array('q'), [])
+        pending[0].append(self._count)
+        pending[1].append(strings)
+        self._count += len(quote_row.sides)
+        if self._count - len(self.timestamp) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Convert the pending strings to numbers, a whole row layout at once"""
+        first = len(self.timestamp)
+        count = self._count - first
+        if count == 0:
+            return
+        option_types = np.zeros(count, dtype=np.int8)
+        values = np.full((count, len(self._float_columns)), nan)
+        for quote_row, (rows, strings) in self._pending.items():
+            rows = np.frombuffer(rows, dtype=np.int64) - first
+            captured = _strings_to_floats(strings, len(quote_row.groups))
+            for index, side in enumerate(quote_row.sides):
+                option_types[rows + index] = side.option_type.value
+                values[(rows + index)[:, None], side.columns] = \
+                    captured[:, side.captured] / side.divisors
+        first_rows, timestamps, expirations, firm_codes, parent_pxs = zip(
+            *self._blocks)
+        lengths = np.diff(np.append(first_rows, self._count))
+        self.timestamp.frombytes(
+            np.repeat(np.array(timestamps, dtype=np.int64), lengths).tobytes())
+        self.expiration.frombytes(
+            np.repeat(np.array(expirations, dtype=np.int64), lengths).tobytes())
+        self.firm.frombytes(
+            np.repeat(np.array(firm_codes, dtype=np.int16), lengths).tobytes())
+        self.option_type.frombytes(option_types.tobytes())
+        values[:, -3:] = np.repeat(np.array(parent_pxs,
+                                   dtype=np.float64), lengths, axis=0)
+        for index, column in enumerate(self._float_columns):
+            getattr(self, column).frombytes(
+                np.ascontiguousarray(values[:, index]).tobytes())
+        self._pending = {}
+        self._blocks = []
+        self._parent_quote = None
+
+    def extend(self, other):
+        """Append all quotes of another QuoteColumns, e.g. one parsed by a worker process"""
+        self.flush()
+        other.flush()
+        self.timestamp.extend(other.timestamp)
+        self.expiration.extend(other.expiration)
+        # the firm codes of the other columns are indices into its own list of firms
+        firm_codes = np.array([self._firm_code(firm)
+                              for firm in other.firms], dtype=np.int16)
+        if len(other):
+            self.firm.frombytes(
+                firm_codes[np.frombuffer(other.firm, dtype=np.int16)].tobytes())
+        self.option_type.extend(other.option_type)
+        for column in self._float_columns:
+            getattr(self, column).extend(getattr(other, column))
+        self._count += len(other)
+
+    def to_arrays(self):
+        """Return a dict of NumPy arrays, each column is copied once from its buffer"""
+        self.flush()
+        arrays = {
+            'timestamp': np.frombuffer(self.timestamp, dtype=np.int64).astype('datetime64[s]'),
+            'expiration': np.frombuffer(self.expiration, dtype=np.int64).astype('datetime64[D]'),
+            'firm': np.frombuffer(self.firm, dtype=np.int16).copy(),
+            'option_type': np.frombuffer(self.option_type, dtype=np.int8).copy(),
+        }
+        for column in self._float_columns:
+            arrays[column] = np.frombuffer(
+                getattr(self, column), dtype=np.float64).copy()
+        return arrays
+
+    def to_option_quotes(self, rows=None):
+        """Return the quotes (or only the given row numbers) as OptionQuote objects"""
+        self.flush()
+        option_quotes = []
+        for i in range(len(self)) if rows is None else rows:
+            timestamp = self._epoch + timedelta(seconds=self.timestamp[i])
+            date = datetime(timestamp.year, timestamp.month, timestamp.day)
+            time = datetime(1900, 1, 1, timestamp.hour,
+                            timestamp.minute, timestamp.second)
+            expiration = self._epoch + timedelta(days=self.expiration[i])
+            floats = [None if isnan(getattr(self, column)[i]) else getattr(self, column)[i]
+                      for column in self._float_columns]
+            option_quotes.append(OptionQuote(date, time, self.firms[self.firm[i]], expiration,
+                                             OptionType(self.option_type[i]), *floats))
+        return option_quotes
+
+
+# build quotes from regular expression matches (shared by the EmailParser classes and the broker formats)
+@lru_cache(maxsize=4096)
+def _strptime(text, format):
+    # a day of emails only has a handful of distinct dates, times and expiries
+    return datetime.strptime(text, format)
+
+
+def _create_company_quote(matched_from):
+    firm = matched_from.group(1)
+    date = _strptime(matched_from.group(2), '%m/%d/%y')
+    time = _strptime(matched_from.group(3), '%H:%M:%S')
+    return OptionQuote(date, time, firm, None, None, None, None, None, None, None, None, None, None, None)
+
+
+def _update_ref_px(matched_subject, company_quote: OptionQuote):
+    company_quote.ref_px = float(matched_subject.group(2))
+
+
+def _optional_float(text):
+    # None for a field that is missing or not a number
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _create_contract_quote(company_quote: OptionQuote, expiry, ref_px, fwd_px=None, fwd_spd=None):
+    return OptionQuote(company_quote.date, company_quote.time, company_quote.firm, expiry, None, None, None, None, None, None, None, None, None, ref_px,
+                       _optional_float(fwd_px), _optional_float(fwd_spd))
+
+
+def _create_contract_quote_xxx(matched_contract, company_quote: OptionQuote):
+    expiry = _strptime(matched_contract.group(1), '%d%b%y')
+    return _create_contract_quote(company_quote, expiry, company_quote.ref_px,
+                                  matched_contract.group(2), matched_contract.group(3))
+
+
+def _create_contract_quote_yyy(matched_contract, company_quote: OptionQuote):
+    expiry = _strptime(matched_contract.group(1), '%d-%b-%Y')
+    return _create_contract_quote(company_quote, expiry, company_quote.ref_px,
+                                  matched_contract.group(2), matched_contract.group(3))
+
+
+def _create_contract_quote_zzz(matched_contract, company_quote: OptionQuote):
+    expiry = _strptime(matched_contract.group(1), '%d-%b-%y')
+    ref_px = float(matched_contract.group(2))
+    return _create_contract_quote(company_quote, expiry, ref_px)
+
+
+def _create_contract_quote_www(matched_contract, company_quote: OptionQuote):
+    expiry = _strptime(matched_contract.group(2), '%d-%b-%y')
+    return _create_contract_quote(company_quote, expiry, company_quote.ref_px,
+                                  matched_contract.group(3))
+
+
+class QuoteSide:
+    """The groups of a quote row match that hold the columns of one option (put or call)"""
+
+    def __init__(self, option_type, price_divisor=1, **groups):
+        # e.g. QuoteSide(OptionType.Put, strike_px=1, bid_px=6, ask_px=7)
+        self.option_type = option_type
+        self.groups = tuple(groups.values())
+        self.columns = np.array([QuoteColumns._float_columns.index(column)
+                                 for column in groups], dtype=np.int64)
+        # some firms quote the prices in cents
+        self.divisors = np.array([price_divisor if column in ('bid_px', 'ask_px') else 1
+                                  for column in groups], dtype=np.float64)
+        self.captured = None  # positions of the groups in the strings captured by the QuoteRow
+
+
+class QuoteRow:
+    """Capture the groups of all options (QuoteSide) of a quote row with a single call"""
+
+    def __init__(self, *sides):
+        self.sides = sides
+        self.groups = ()
+        for side in sides:
+            side.captured = np.arange(
+                len(self.groups), len(self.groups) + len(side.groups))
+            self.groups += side.groups
+
+    def __call__(self, matched, contract_quote: OptionQuote, price_quotes: QuoteColumns):
+        if len(self.groups) > 1:
+            strings = matched.group(*self.groups)
+        else:
+            strings = tuple(matched.group(group) for group in self.groups)
+        price_quotes.add_row(contract_quote, self, strings)
+
+
+def _strings_to_floats(strings, width):
+    """Convert a list of tuples of number strings into a 2-D float array, '--' becomes NaN"""
+    if width == 0:
+        return np.empty((len(strings), 0))
+    # parsing one joined string in C is about twice as fast as casting an array of strings
+    text = ' %s ' % ' '.join(chain.from_iterable(strings))
+    # '--' means no price was quoted, adjacent ones need a second pass
+    text = text.replace(' -- ', ' nan ').replace(' -- ', ' nan ')
+    floats = np.fromstring(text, sep=' ')
+    if floats.size != len(strings) * width:
+        raise ValueError('could not convert the quote strings to numbers')
+    return floats.reshape(len(strings), width)
+
+
+_quote_row_xxx = QuoteRow(
+    QuoteSide(OptionType.Put, strike_px=1, strike_spd=3, bid_px=6, ask_px=7,
+              delta=9, implied_vol_spd=14, implied_vol_bps=18),
+    QuoteSide(OptionType.Call, strike_px=1, strike_spd=3, bid_px=11, ask_px=12,
+              delta=9, implied_vol_spd=14, implied_vol_bps=18))
+_quote_row_yyy = QuoteRow(
+    QuoteSide(OptionType.Put, 100, strike_px=1, strike_spd=3, bid_px=6, ask_px=8,
+              delta=10, implied_vol_spd=23, implied_vol_bps=28),
+    QuoteSide(OptionType.Call, 100, strike_px=1, strike_spd=3, bid_px=13, ask_px=15,
+              delta=17, implied_vol_spd=23, implied_vol_bps=28))
+_quote_row_zzz = QuoteRow(
+    QuoteSide(OptionType.Put, 100, strike_px=1, bid_px=4, ask_px=7,
+              delta=9, implied_vol_spd=20, implied_vol_px=26),
+    QuoteSide(OptionType.Call, 100, strike_px=1, bid_px=12, ask_px=15,
+              delta=17, implied_vol_spd=20, implied_vol_px=26))
+_quote_row_www_call_put = QuoteRow(
+    QuoteSide(OptionType.Put, 100, strike_px=15, bid_px=18, ask_px=19,
+              delta=21, implied_vol_spd=23, implied_vol_bps=27),
+    QuoteSide(OptionType.Call, 100, strike_px=1, bid_px=4, ask_px=5,
+              delta=7, implied_vol_spd=9, implied_vol_bps=13))
+_quote_row_www_put_only = QuoteRow(
+    QuoteSide(OptionType.Put, 100, strike_px=2, bid_px=5, ask_px=6,
+              delta=8, implied_vol_spd=10, implied_vol_bps=14),
+    # the call side of the row is empty, keep an empty call row like the other brokers
+    QuoteSide(OptionType.Call))
+
+
+def _remove_non_breaking_space(line):
+    return re.sub('Â\xa0', '', line)
 
 
 class EmailParser:
@@ -43,12 +342,7 @@ class EmailParser:
 
     def create_company_quote(self):
         if self.matched_from:
-            firm = self.matched_from.group(1)
-            date = datetime.strptime(
-                self.matched_from.group(2), '%m/%d/%y')
-            time = datetime.strptime(
-                self.matched_from.group(3), '%H:%M:%S')
-            return OptionQuote(date, time, firm, None, None, None, None, None, None, None, None, None, None, None)
+            return _create_company_quote(self.matched_from)
         else:
             return None
 
@@ -69,38 +363,19 @@ class EmailParserXXX(EmailParser):
 
     def update_company_quote(self, company_quote: OptionQuote):
         if self.matched_subject:
-            subject = self.matched_subject.group(1)
-            ref_px = float(self.matched_subject.group(2))
-            company_quote.ref_px = ref_px
+            _update_ref_px(self.matched_subject, company_quote)
 
     def create_contract_quote(self, company_quote: OptionQuote):
         if self.matched_contract:
-            expiry = datetime.strptime(
-                self.matched_contract.group(1), '%d%b%y')
-            return OptionQuote(company_quote.date, company_quote.time, company_quote.firm, expiry, None, None, None, None, None, None, None, None, None, company_quote.ref_px)
+            return _create_contract_quote_xxx(self.matched_contract, company_quote)
         else:
             return None
 
     def create_price_quotes(self, contract_quote: OptionQuote):
         if (self.matched_quote):
-            strike_px = float(self.matched_quote.group(1))
-            strike_spd = float(self.matched_quote.group(3))
-            bid_price_put = None if self.matched_quote.group(
-                6) == '--' else float(self.matched_quote.group(6))
-            ask_price_put = None if self.matched_quote.group(
-                7) == '--' else float(self.matched_quote.group(7))
-            delta = float(self.matched_quote.group(9))
-            bid_price_call = None if self.matched_quote.group(
-                11) == '--' else float(self.matched_quote.group(11))
-            ask_price_call = None if self.matched_quote.group(
-                12) == '--' else float(self.matched_quote.group(12))
-            implied_vol_spread = float(self.matched_quote.group(14))
-            implied_vol_bps = float(self.matched_quote.group(18))
-            put_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Put,
-                                           strike_px, strike_spd, bid_price_put, ask_price_put, delta, implied_vol_spread, implied_vol_bps, None, contract_quote.ref_px)
-            call_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Call,
-                                            strike_px, strike_spd, bid_price_call, ask_price_call, delta, implied_vol_spread, implied_vol_bps, None, contract_quote.ref_px)
-            return put_option_quote, call_option_quote
+            price_quotes = QuoteColumns()
+            _quote_row_xxx(self.matched_quote, contract_quote, price_quotes)
+            return tuple(price_quotes.to_option_quotes())
         else:
             return None, None
 
@@ -121,39 +396,19 @@ class EmailParserYYY(EmailParser):
 
     def update_company_quote(self, company_quote: OptionQuote):
         if self.matched_subject:
-            subject = self.matched_subject.group(1)
-            ref_px = float(self.matched_subject.group(2))
-            company_quote.ref_px = ref_px
+            _update_ref_px(self.matched_subject, company_quote)
 
     def create_contract_quote(self, company_quote: OptionQuote):
         if self.matched_contract:
-            expiry = datetime.strptime(
-                self.matched_contract.group(1), '%d-%b-%Y')
-            return OptionQuote(company_quote.date, company_quote.time, company_quote.firm, expiry, None, None, None, None, None, None, None, None, None, company_quote.ref_px)
+            return _create_contract_quote_yyy(self.matched_contract, company_quote)
         else:
             return None
 
     def create_price_quotes(self, contract_quote: OptionQuote):
         if (self.matched_quote):
-            strike_px = float(self.matched_quote.group(1))
-            strike_spd = float(self.matched_quote.group(3))
-            bid_price_put = None if self.matched_quote.group(
-                6) == '--' else float(self.matched_quote.group(6))/100
-            ask_price_put = None if self.matched_quote.group(
-                8) == '--' else float(self.matched_quote.group(8))/100
-            delta_put = float(self.matched_quote.group(10))
-            bid_price_call = None if self.matched_quote.group(
-                13) == '--' else float(self.matched_quote.group(13))/100
-            ask_price_call = None if self.matched_quote.group(
-                15) == '--' else float(self.matched_quote.group(15))/100
-            delta_call = float(self.matched_quote.group(17))
-            implied_vol_spread = float(self.matched_quote.group(23))
-            implied_vol_bps = float(self.matched_quote.group(28))
-            put_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Put,
-                                           strike_px, strike_spd, bid_price_put, ask_price_put, delta_put, implied_vol_spread, implied_vol_bps, None, contract_quote.ref_px)
-            call_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Call,
-                                            strike_px, strike_spd, bid_price_call, ask_price_call, delta_call, implied_vol_spread, implied_vol_bps, None, contract_quote.ref_px)
-            return put_option_quote, call_option_quote
+            price_quotes = QuoteColumns()
+            _quote_row_yyy(self.matched_quote, contract_quote, price_quotes)
+            return tuple(price_quotes.to_option_quotes())
         else:
             return None, None
 
@@ -178,7 +433,7 @@ class EmailParserZZZ(EmailParser):
         '(-*\d*\.?\d+)(\s+)\|(\s+)(-*\d*\.?\d+)(\s+)\/(\s+)(-*\d*\.?\d+)(\s+)(-*\d*\.?\d+)(\s+)\|(\s+)(-*\d*\.?\d+)(\s+)\/(\s+)(-*\d*\.?\d+)(\s+)(-*\d*\.?\d+)(\s+)\|(\s+)(-*\d*\.?\d+)(\s+)(\+?)(-*\d*\.?\d+)(\s+)\|(\s+)(-*\d*\.?\d+)')
 
     def __init__(self, line):
-        line = re.sub('Â\xa0', '', line)  # remove non-breaking space
+        line = _remove_non_breaking_space(line)
         super().__init__(line)
         self.matched_subject = self._reg_subject.match(line)
         self.matched_quote = self._reg_quote.match(line)
@@ -189,33 +444,15 @@ class EmailParserZZZ(EmailParser):
 
     def create_contract_quote(self, company_quote: OptionQuote):
         if self.matched_contract:
-            expiry = datetime.strptime(
-                self.matched_contract.group(1), '%d-%b-%y')
-            ref_px = float(self.matched_contract.group(2))
-            return OptionQuote(company_quote.date, company_quote.time, company_quote.firm, expiry, None, None, None, None, None, None, None, None, None, ref_px)
+            return _create_contract_quote_zzz(self.matched_contract, company_quote)
         else:
             return None
 
     def create_price_quotes(self, contract_quote: OptionQuote):
         if self.matched_quote:
-            strike_px = float(self.matched_quote.group(1))
-            bid_price_put = None if self.matched_quote.group(
-                4) == '--' else float(self.matched_quote.group(4))/100
-            ask_price_put = None if self.matched_quote.group(
-                7) == '--' else float(self.matched_quote.group(7))/100
-            delta_put = float(self.matched_quote.group(9))
-            bid_price_call = None if self.matched_quote.group(
-                12) == '--' else float(self.matched_quote.group(12))/100
-            ask_price_call = None if self.matched_quote.group(
-                15) == '--' else float(self.matched_quote.group(15))/100
-            delta_call = float(self.matched_quote.group(17))
-            implied_vol_spread = float(self.matched_quote.group(20))
-            implied_vol_px = float(self.matched_quote.group(26))
-            put_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Put,
-                                           strike_px, None, bid_price_put, ask_price_put, delta_put, implied_vol_spread, None, implied_vol_px, contract_quote.ref_px)
-            call_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Call,
-                                            strike_px, None, bid_price_call, ask_price_call, delta_call, implied_vol_spread, None, implied_vol_px, contract_quote.ref_px)
-            return put_option_quote, call_option_quote
+            price_quotes = QuoteColumns()
+            _quote_row_zzz(self.matched_quote, contract_quote, price_quotes)
+            return tuple(price_quotes.to_option_quotes())
         else:
             return None, None
 
@@ -241,126 +478,834 @@ class EmailParserWWW(EmailParser):
 
     def update_company_quote(self, company_quote: OptionQuote):
         if self.matched_subject:
-            subject = self.matched_subject.group(1)
-            ref_px = float(self.matched_subject.group(2))
-            company_quote.ref_px = ref_px
+            _update_ref_px(self.matched_subject, company_quote)
 
     def create_contract_quote(self, company_quote: OptionQuote):
         if self.matched_contract:
-            expiry = datetime.strptime(
-                self.matched_contract.group(2), '%d-%b-%y')
-            return OptionQuote(company_quote.date, company_quote.time, company_quote.firm, expiry, None, None, None, None, None, None, None, None, None, company_quote.ref_px)
+            return _create_contract_quote_www(self.matched_contract, company_quote)
         else:
             return None
 
     def create_price_quotes(self, contract_quote: OptionQuote):
         if (self.matched_quote_call_put):
-            strike_px_call = float(self.matched_quote.group(1))
-            bid_price_call = None if self.matched_quote.group(
-                4) == '--' else float(self.matched_quote.group(4))/100
-            ask_price_call = None if self.matched_quote.group(
-                5) == '--' else float(self.matched_quote.group(5))/100
-            delta_call = float(self.matched_quote.group(7))
-            implied_vol_spread_call = float(self.matched_quote.group(9))
-            implied_vol_bps_call = float(self.matched_quote.group(13))
-
-            strike_px_put = float(self.matched_quote.group(15))
-            bid_price_put = None if self.matched_quote.group(
-                18) == '--' else float(self.matched_quote.group(18))/100
-            ask_price_put = None if self.matched_quote.group(
-                19) == '--' else float(self.matched_quote.group(19))/100
-            delta_put = float(self.matched_quote.group(21))
-            implied_vol_spread_put = float(self.matched_quote.group(23))
-            implied_vol_bps_put = float(self.matched_quote.group(27))
-            put_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Put,
-                                           strike_px_put, None, bid_price_put, ask_price_put, delta_put, implied_vol_spread_put, implied_vol_bps_put, None, contract_quote.ref_px)
-            call_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Call,
-                                            strike_px_call, None, bid_price_call, ask_price_call, delta_call, implied_vol_spread_call, implied_vol_bps_call, None, contract_quote.ref_px)
-            return put_option_quote, call_option_quote
+            price_quotes = QuoteColumns()
+            _quote_row_www_call_put(self.matched_quote_call_put, contract_quote, price_quotes)
+            return tuple(price_quotes.to_option_quotes())
         elif (self.matched_quote_put_only):
-            strike_px_put = float(self.matched_quote.group(2))
-            bid_price_put = None if self.matched_quote.group(
-                5) == '--' else float(self.matched_quote.group(5))/100
-            ask_price_put = None if self.matched_quote.group(
-                6) == '--' else float(self.matched_quote.group(6))/100
-            delta_put = float(self.matched_quote.group(8))
-            implied_vol_spread_put = float(self.matched_quote.group(10))
-            implied_vol_bps_put = float(self.matched_quote.group(14))
-            put_option_quote = OptionQuote(contract_quote.date, contract_quote.time, contract_quote.firm, contract_quote.expiration, OptionType.Put,
-                                           strike_px_put, None, bid_price_put, ask_price_put, delta_put, implied_vol_spread_put, implied_vol_bps_put, None, contract_quote.ref_px)
-            call_option_quote = copy.deepcopy(contract_quote)
-            return put_option_quote, call_option_quote
+            price_quotes = QuoteColumns()
+            _quote_row_www_put_only(self.matched_quote_put_only, contract_quote, price_quotes)
+            return tuple(price_quotes.to_option_quotes())
         else:
             return None, None
 
 
+class LineRule:
+    """A regular expression that is only tried on lines starting with one of its prefixes"""
+
+    def __init__(self, prefixes, regex, action):
+        # action receives the match and the parent quote, see process_option_quote
+        self.prefixes = tuple(prefixes)
+        self.regex = regex
+        self.action = action
+
+
+class BrokerFormat:
+    """Declarative description of the lines of one firm's quote emails"""
+
+    # every quote table row starts with a number (the strike)
+    numeric_prefixes = tuple('-.0123456789')
+
+    def __init__(self, firm, subject=None, contract=None, quotes=(), normalize=None):
+        self.firm = firm
+        self.subject = subject
+        self.contract = contract
+        self.quotes = tuple(quotes)
+        self.normalize = normalize
+        # index the rules by first character so that a line is only compared with the prefixes it can start with
+        self._rules_by_first_char = {}
+        rules = [('from', _from_rule), ('subject', subject), ('contract', contract)]
+        rules.extend(('quote', rule) for rule in self.quotes)
+        for kind, rule in rules:
+            if rule is None:
+                continue
+            for prefix in rule.prefixes:
+                self._rules_by_first_char.setdefault(
+                    prefix[:1], []).append((prefix, kind, rule))
+
+    def classify(self, line, pos=0):
+        """Return the (kind, rule) of the only rule that can match the line starting at pos, or (None, None)"""
+        for prefix, kind, rule in self._rules_by_first_char.get(line[pos:pos + 1], ()):
+            if line.startswith(prefix, pos):
+                return kind, rule
+        return None, None
+
+
+_from_rule = LineRule(('From:',), EmailParser._reg_from, None)
+
+# lines before the first 'From:' header only need to be checked for it
+_unknown_broker_format = BrokerFormat(None)
+
+BROKER_FORMATS = {}
+
+
+def register_broker_format(broker_format: BrokerFormat):
+    BROKER_FORMATS[broker_format.firm] = broker_format
+
+
+register_broker_format(BrokerFormat(
+    'XXX',
+    subject=LineRule(('Subject:',), EmailParserXXX._reg_subject, _update_ref_px),
+    contract=LineRule(('Expiry',), EmailParserXXX._reg_contract,
+                      _create_contract_quote_xxx),
+    quotes=[LineRule(BrokerFormat.numeric_prefixes, EmailParserXXX._reg_quote,
+                     _quote_row_xxx)]))
+register_broker_format(BrokerFormat(
+    'YYY',
+    subject=LineRule(('Subject:',), EmailParserYYY._reg_subject, _update_ref_px),
+    contract=LineRule(('EXPIRY:',), EmailParserYYY._reg_contract,
+                      _create_contract_quote_yyy),
+    quotes=[LineRule(BrokerFormat.numeric_prefixes, EmailParserYYY._reg_quote,
+                     _quote_row_yyy)]))
+register_broker_format(BrokerFormat(
+    'ZZZ',
+    # the subject line carries no reference price
+    subject=LineRule(('Subject:',), EmailParserZZZ._reg_subject, None),
+    contract=LineRule(('Exp:',), EmailParserZZZ._reg_contract,
+                      _create_contract_quote_zzz),
+    quotes=[LineRule(BrokerFormat.numeric_prefixes, EmailParserZZZ._reg_quote,
+                     _quote_row_zzz)],
+    normalize=_remove_non_breaking_space))
+register_broker_format(BrokerFormat(
+    'WWW',
+    subject=LineRule(('Subject:',), EmailParserWWW._reg_subject, _update_ref_px),
+    contract=LineRule(('CDX Options:',), EmailParserWWW._reg_contract,
+                      _create_contract_quote_www),
+    quotes=[LineRule(BrokerFormat.numeric_prefixes, EmailParserWWW._reg_quote_call_put,
+                     _quote_row_www_call_put),
+            LineRule(('  -  |',), EmailParserWWW._reg_quote_put_only,
+                     _quote_row_www_put_only)]))
+
+
+def _broker_format(parent_quotes):
+    if parent_quotes[0] is None:
+        return _unknown_broker_format
+    return BROKER_FORMATS.get(parent_quotes[0].firm, _unknown_broker_format)
+
+
+def _apply_rule(kind, rule, matched, parent_quotes, price_quotes):
+    if kind == 'from':
+        parent_quotes[0] = _create_company_quote(matched)
+    elif kind == 'subject':
+        if rule.action:
+            rule.action(matched, parent_quotes[0])
+    elif kind == 'contract':
+        parent_quotes[1] = rule.action(matched, parent_quotes[0])
+    elif kind == 'quote':
+        rule.action(matched, parent_quotes[1], price_quotes)
+
+
+def _process_line(text, pos, endpos, broker_format, parent_quotes, price_quotes):
+    # the line is text[pos:endpos], it is matched in place instead of being copied
+    kind, rule = broker_format.classify(text, pos)
+    if rule is None:
+        return
+    matched = rule.regex.match(text, pos, endpos)
+    if not matched:
+        return
+    # dispatched inline rather than through _apply_rule, this runs for every line
+    if kind == 'quote':
+        rule.action(matched, parent_quotes[1], price_quotes)
+    else:
+        _apply_rule(kind, rule, matched, parent_quotes, price_quotes)
+
+
+class ParseStats:
+    """Counters of the lines seen and matched per firm and line kind, see enable_stats
+
+    A line is of kind 'from', 'subject', 'contract' or 'quote' when it starts like one of the
+    rules of its firm, and 'other' otherwise. Matched lines are the ones whose regex matched.
+    Up to `samples` unmatched non-blank lines are kept per firm and kind (reservoir sampling).
+    """
+    kinds = ('from', 'subject', 'contract', 'quote', 'other')
+
+    def __init__(self, samples=5, seed=0):
+        self.samples = samples
+        self.lines = {}  # firm -> kind -> [seen, matched]
+        self.regex_seconds = {}  # firm -> kind -> seconds spent in the regexes of the rules
+        self.unmatched = {}  # firm -> kind -> sampled unmatched lines
+        self.quotes = {}  # firm -> quotes emitted
+        self.seconds = 0.0  # time spent processing lines
+        self._random = random.Random(seed)
+
+    def _firm(self, firm):
+        if firm not in self.lines:
+            self.lines[firm] = {kind: [0, 0] for kind in self.kinds}
+            self.regex_seconds[firm] = {kind: 0.0 for kind in self.kinds}
+            self.unmatched[firm] = {kind: [] for kind in self.kinds}
+            self.quotes[firm] = 0
+        return firm
+
+    def _sample(self, firm, kind, line, unmatched):
+        # unmatched is the number of unmatched lines of the firm and kind, including this one
+        sampled = self.unmatched[firm][kind]
+        if len(sampled) < self.samples:
+            sampled.append(line)
+        else:
+            index = self._random.randrange(unmatched)
+            if index < self.samples:
+                sampled[index] = line
+
+    def process_line(self, text, pos, endpos, broker_format, parent_quotes, price_quotes):
+        """Same as _process_line, counting and timing what it does"""
+        if text.startswith('\n', pos):
+            # blank lines are skipped by process_option_quote, so they are not counted on any path
+            return
+        started = time.perf_counter()
+        kind, rule = broker_format.classify(text, pos)
+        matched = None
+        regex_seconds = 0.0
+        if rule is not None:
+            matched = rule.regex.match(text, pos, endpos)
+            regex_seconds = time.perf_counter() - started
+        else:
+            kind = 'other'
+        count = len(price_quotes)
+        if matched:
+            _apply_rule(kind, rule, matched, parent_quotes, price_quotes)
+        # a 'From:' line is parsed with the format of the previous message but counted for its own firm
+        firm = self._firm(parent_quotes[0].firm if matched and kind == 'from'
+                          else broker_format.firm or 'unknown')
+        counts = self.lines[firm][kind]
+        counts[0] += 1
+        self.regex_seconds[firm][kind] += regex_seconds
+        if matched:
+            counts[1] += 1
+            self.quotes[firm] += len(price_quotes) - count
+        else:
+            line = text[pos:endpos].rstrip('\n')
+            if line.strip():
+                self._sample(firm, kind, line, counts[0] - counts[1])
+        self.seconds += time.perf_counter() - started
+
+    def merge(self, other):
+        """Add the counters of another ParseStats, e.g. of a worker process"""
+        for firm in other.lines:
+            self._firm(firm)
+            for kind in self.kinds:
+                unmatched = self.lines[firm][kind][0] - \
+                    self.lines[firm][kind][1]
+                for index in range(2):
+                    self.lines[firm][kind][index] += other.lines[firm][kind][index]
+                self.regex_seconds[firm][kind] += other.regex_seconds[firm][kind]
+                for line in other.unmatched[firm][kind]:
+                    unmatched += 1
+                    self._sample(firm, kind, line, unmatched)
+            self.quotes[firm] += other.quotes[firm]
+        self.seconds += other.seconds
+
+    def to_dict(self):
+        quotes = sum(self.quotes.values())
+        return {
+            'seconds': self.seconds,
+            'quotes': quotes,
+            'quotes_per_second': quotes / self.seconds if self.seconds else 0.0,
+            'firms': {firm: {
+                'quotes': self.quotes[firm],
+                'lines': {kind: {'seen': seen, 'matched': matched, 'unmatched': seen - matched}
+                          for kind, (seen, matched) in self.lines[firm].items() if seen},
+                'regex_seconds': {kind: seconds for kind, seconds in self.regex_seconds[firm].items() if seconds},
+                'unmatched_samples': {kind: lines for kind, lines in self.unmatched[firm].items() if lines},
+            } for firm in self.lines},
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+
+# the ParseStats that lines are counted in, None when the instrumentation is disabled
+_parse_stats = None
+
+
+def enable_stats(stats=None):
+    """Count the lines parsed from now on in stats (a new ParseStats by default) and return it"""
+    global _parse_stats
+    _parse_stats = stats if stats is not None else ParseStats()
+    return _parse_stats
+
+
+def disable_stats():
+    global _parse_stats
+    _parse_stats = None
+
+
+def _line_processor():
+    # chosen once per block of lines, so that disabled stats cost nothing per line
+    return _process_line if _parse_stats is None else _parse_stats.process_line
+
+
 def process_option_quote(line, parent_quotes, price_quotes):
-    parser = None
     if line == '\n':
         return
-    if(parent_quotes[0] is None):
-        parser = EmailParser(line)
-    elif (parent_quotes[0].firm == 'XXX'):
-        parser = EmailParserXXX(line)
-    elif (parent_quotes[0].firm == 'YYY'):
-        parser = EmailParserYYY(line)
-    elif (parent_quotes[0].firm == 'ZZZ'):
-        parser = EmailParserZZZ(line)
-    elif (parent_quotes[0].firm == 'WWW'):
-        parser = EmailParserWWW(line)
-
-    if parser.matched_from:
-        parent_quotes[0] = parser.create_company_quote()
-    elif parser.matched_subject:
-        parser.update_company_quote(parent_quotes[0])
-    elif parser.matched_contract:
-        parent_quotes[1] = parser.create_contract_quote(parent_quotes[0])
-    elif parser.matched_quote:
-        put_price_quote, call_price_quote = parser.create_price_quotes(
-            parent_quotes[1])
-        price_quotes.append(put_price_quote)
-        price_quotes.append(call_price_quote)
-
-
-def convert_to_dataframe(price_quotes):
-    data = {'Date': [], 'Time': [], 'Firm': [], 'Expiration': [], 'Option Type': [], 'Strike Px': [], 'Bid Price': [
-    ], 'Ask Price': [], 'Delta': [], 'Implied Vol Spd': [], 'Implied Vol Bps': [], 'Implied Vol Px': [], 'Ref Px': []}
-    for quote in price_quotes:
-        data['Date'].append(quote.date.strftime('%d-%b-%y'))
-        data['Time'].append(quote.time.strftime('%H:%M:%S'))
-        data['Firm'].append(quote.firm)
-        data['Expiration'].append(quote.expiration.strftime('%d-%b-%y'))
-        data['Option Type'].append(
-            'P' if quote.option_type == OptionType.Put else 'C')
-        data['Strike Px'].append(quote.strike_px)
-        data['Bid Price'].append(quote.bid_px)
-        data['Ask Price'].append(quote.ask_px)
-        data['Delta'].append(quote.delta)
-        data['Implied Vol Spd'].append(quote.implied_vol_spd)
-        data['Implied Vol Bps'].append(quote.implied_vol_bps)
-        data['Implied Vol Px'].append(quote.implied_vol_px)
-        data['Ref Px'].append(quote.ref_px)
-    df = pd.DataFrame(data)
+    broker_format = _broker_format(parent_quotes)
+    if broker_format.normalize:
+        line = broker_format.normalize(line)
+    _line_processor()(line, 0, len(line), broker_format,
+                      parent_quotes, price_quotes)
+
+
+# a literal newline is much faster to scan for than a MULTILINE '^'
+_reg_message = re.compile('\nFrom: ')
+
+
+def _process_lines(text, pos, endpos, broker_format, parent_quotes, price_quotes):
+    process_line = _line_processor()
+    while pos < endpos:
+        line_end = text.find('\n', pos, endpos) + 1 or endpos
+        process_line(text, pos, line_end, broker_format,
+                     parent_quotes, price_quotes)
+        pos = line_end
+
+
+def process_option_quote_text(text, parent_quotes, price_quotes):
+    """Parse a buffer of lines, with the same result as process_option_quote on each of its lines
+
+    The messages are located with a single pass over the buffer. Only the 'From:' line of a message
+    can change the firm, so the rest of the message is parsed with one broker format and normalised
+    once instead of line by line.
+    """
+    starts = [0]
+    starts.extend(matched.start() + 1 for matched in _reg_message.finditer(text))
+    starts.append(len(text))
+    for start, end in zip(starts, starts[1:]):
+        if text.startswith('From: ', start):
+            # the 'From:' line itself is still parsed with the format of the previous message
+            line_end = text.find('\n', start, end) + 1 or end
+            process_option_quote(
+                text[start:line_end], parent_quotes, price_quotes)
+            start = line_end
+        broker_format = _broker_format(parent_quotes)
+        if broker_format.normalize:
+            block = broker_format.normalize(text[start:end])
+            _process_lines(block, 0, len(block), broker_format,
+                           parent_quotes, price_quotes)
+        else:
+            _process_lines(text, start, end, broker_format,
+                           parent_quotes, price_quotes)
+
+
+def _decode(data):
+    # decode the same way as open(path, 'r') does, including the universal newlines
+    text = str(data, locale.getpreferredencoding(False))
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def read_quote_file(path, price_quotes, start=0, end=None):
+    """Memory-map a file and parse its bytes [start, end), which must begin at a message boundary"""
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            view = memoryview(buffer)
+            try:
+                text = _decode(view[start:end])
+            finally:
+                view.release()
+    process_option_quote_text(text, [None, None], price_quotes)
+
+
+def convert_to_dataframe(price_quotes: QuoteColumns):
+    arrays = price_quotes.to_arrays()
+    timestamp = arrays['timestamp']
+    date = timestamp.astype('datetime64[D]')
+    option_type = pd.Categorical.from_codes(
+        (arrays['option_type'] == OptionType.Call.value).astype(np.int8), ['P', 'C'])
+    data = {'Date': date.astype('datetime64[s]'),
+            'Time': timestamp - date,
+            'Firm': pd.Categorical.from_codes(arrays['firm'], price_quotes.firms),
+            'Expiration': arrays['expiration'].astype('datetime64[s]'),
+            'Option Type': option_type,
+            'Strike Px': arrays['strike_px'],
+            'Strike Spd': arrays['strike_spd'],
+            'Bid Price': arrays['bid_px'],
+            'Ask Price': arrays['ask_px'],
+            'Delta': arrays['delta'],
+            'Implied Vol Spd': arrays['implied_vol_spd'],
+            'Implied Vol Bps': arrays['implied_vol_bps'],
+            'Implied Vol Px': arrays['implied_vol_px'],
+            'Ref Px': arrays['ref_px']}
+    df = pd.DataFrame(data, copy=False)
     return df
 
 
+def write_excel(df, path):
+    # Excel has no time-of-day duration, so write the times as datetime.time
+    df = df.assign(Time=(pd.Timestamp(0) + df['Time']).dt.time)
+    with pd.ExcelWriter(path) as writer:  # pip install openpyxl
+        df.to_excel(writer, index=False)
+        worksheet = writer.sheets['Sheet1']
+        for column in ('Date', 'Expiration'):
+            letter = chr(ord('A') + df.columns.get_loc(column))
+            for cell in worksheet[letter][1:]:
+                cell.number_format = 'd-mmm-yy'
+
+
+def _write_parquet(df, path):
+    df.to_parquet(path, index=False)  # pip install pyarrow
+
+
+def _write_arrow(df, path):
+    # Arrow IPC (Feather v2) files can be memory-mapped by the readers
+    df.reset_index(drop=True).to_feather(path)  # pip install pyarrow
+
+
+def _write_csv(df, path):
+    df = df.assign(Time=(pd.Timestamp(0) + df['Time']).dt.strftime('%H:%M:%S'))
+    df.to_csv(path, index=False, date_format='%Y-%m-%d')
+
+
+# output format -> (file extension, writer of one partition file)
+OUTPUT_WRITERS = {
+    'parquet': ('.parquet', _write_parquet),
+    'arrow': ('.arrow', _write_arrow),
+    'csv': ('.csv', _write_csv),
+}
+
+
+def _message_keys(df):
+    # a message is identified by its firm and the date and time of its 'From:' line
+    return df['Firm'].astype(str) + ' ' + (df['Date'] + df['Time']).dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _next_part(directory, partition_directory, extension):
+    # never reuse the name of a file already there, whether the manifest lists it or not
+    names = set(os.listdir(os.path.join(directory, partition_directory)))
+    index = len(names)
+    while 'part-{:05d}{}'.format(index, extension) in names:
+        index += 1
+    return os.path.join(partition_directory, 'part-{:05d}{}'.format(index, extension))
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)
+
+
+def write_partitioned(df, directory, output_format='parquet'):
+    """Append the quotes not written before to a dataset partitioned by trade date and firm
+
+    Every run adds new part files under directory/trade_date=YYYY-MM-DD/firm=XXX/ and never rewrites
+    existing ones, so readers such as pyarrow.dataset can prune whole partitions by date or firm.
+    directory/_manifest.json lists the part files and the number of rows written of every message, so
+    the rest of a message that was only partly in its file the first time is appended later.
+    The part files about to be written are listed in directory/_pending.json first; a run that crashed
+    before updating the manifest leaves them there and the next run deletes them. Without a manifest
+    no file is deleted.
+    Returns the number of rows written.
+    """
+    extension, writer = OUTPUT_WRITERS[output_format]
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, '_manifest.json')
+    pending_path = os.path.join(directory, '_pending.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    if os.path.exists(pending_path):
+        if manifest is not None:
+            with open(pending_path, 'r') as file:
+                pending = json.load(file)
+            # parts written by a run that crashed before updating the manifest
+            for part in set(pending) - set(manifest['parts']):
+                if os.path.exists(os.path.join(directory, part)):
+                    os.remove(os.path.join(directory, part))
+        os.remove(pending_path)
+    if manifest is None:
+        manifest = {'messages': {}, 'parts': []}
+    written = manifest['messages']
+    parts = set(manifest['parts'])
+
+    # the rows of a message come in the order of its file, so the rows past the count written are new
+    keys = _message_keys(df)
+    new = (keys.groupby(keys, sort=False).cumcount() >= keys.map(written).fillna(0)).to_numpy()
+    df = df[new]
+    if len(df) == 0:
+        return 0
+    partitions = []
+    for (date, firm), partition in df.groupby([df['Date'], df['Firm']], observed=True, sort=True):
+        partition_directory = os.path.join('trade_date=' + date.strftime('%Y-%m-%d'),
+                                           'firm=' + str(firm))
+        os.makedirs(os.path.join(directory, partition_directory), exist_ok=True)
+        partitions.append((_next_part(directory, partition_directory, extension), partition))
+    _write_json(pending_path, sorted(part for part, _ in partitions))
+    for part, partition in partitions:
+        # rows sorted by expiry give tight min/max statistics for filters on the expiry
+        writer(partition.sort_values('Expiration', kind='stable'),
+               os.path.join(directory, part))
+        parts.add(part)
+
+    for key, count in keys[new].value_counts(sort=False).items():
+        written[key] = written.get(key, 0) + int(count)
+    _write_json(manifest_path, {'messages': dict(sorted(written.items())), 'parts': sorted(parts)})
+    os.remove(pending_path)
+    return len(df)
+
+
+def _parse_range(task):
+    path, start, end = task
+    price_quotes = QuoteColumns()
+    read_quote_file(path, price_quotes, start, end)
+    return price_quotes
+
+
+def _split_messages(path, split_size):
+    """Split a file into ranges of whole messages of about split_size bytes"""
+    size = os.path.getsize(path)
+    if size <= split_size:
+        return [(path, 0, size)]
+    ranges = []
+    start = 0
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # the parent quotes are reset by every 'From:' line, so messages can be parsed independently
+            position = buffer.find(b'\nFrom: ', split_size)
+            while position != -1:
+                ranges.append((path, start, position + 1))
+                start = position + 1
+                position = buffer.find(b'\nFrom: ', start + split_size)
+    ranges.append((path, start, size))
+    return ranges
+
+
+def _parse_range_counted(task, samples):
+    # a worker process counts each range in its own ParseStats, parse_files merges them
+    stats = enable_stats(ParseStats(samples))
+    try:
+        return _parse_range(task), stats
+    finally:
+        disable_stats()
+
+
+def parse_files(paths, workers=1, split_size=4 * 1024 * 1024):
+    """Parse the quote files and return the quotes in the order of paths
+
+    With more than one worker the files are parsed in a process pool and files larger
+    than split_size are cut into ranges of whole messages that are parsed in parallel.
+    """
+    if workers > 1:
+        tasks = [task for path in paths for task in _split_messages(
+            path, split_size)]
+        stats = _parse_stats
+        with ProcessPoolExecutor(workers) as executor:
+            chunksize = max(1, len(tasks) // (workers * 4))
+            if stats is None:
+                results = list(executor.map(
+                    _parse_range, tasks, chunksize=chunksize))
+            else:
+                results = list(executor.map(_parse_range_counted, tasks, repeat(stats.samples),
+                                            chunksize=chunksize))
+        if stats is not None:
+            for _, worker_stats in results:
+                stats.merge(worker_stats)
+            results = [result for result, _ in results]
+    else:
+        results = [_parse_range((path, 0, os.path.getsize(path)))
+                   for path in paths]
+    price_quotes = QuoteColumns()
+    for result in results:
+        price_quotes.extend(result)
+    return price_quotes
+
+
+def _option_quote_to_json(quote: OptionQuote):
+    if quote is None:
+        return None
+    fields = dict(vars(quote))
+    for name in ('date', 'time', 'expiration'):
+        if fields[name] is not None:
+            fields[name] = fields[name].isoformat()
+    if fields['option_type'] is not None:
+        fields['option_type'] = fields['option_type'].name
+    return fields
+
+
+def _option_quote_from_json(fields):
+    if fields is None:
+        return None
+    fields = dict(fields)
+    for name in ('date', 'time', 'expiration'):
+        if fields[name] is not None:
+            fields[name] = datetime.fromisoformat(fields[name])
+    if fields['option_type'] is not None:
+        fields['option_type'] = OptionType[fields['option_type']]
+    return OptionQuote(**fields)
+
+
+class QuoteStream:
+    """Follow the quote files of a drop directory and parse only what was appended since the last poll
+
+    The byte offset and the parent quotes of every file are saved to the checkpoint file after each
+    batch was handed over, so a restarted stream resumes where it stopped without emitting a quote twice.
+    A file is read again from the start when it shrank, when it is another file under the same name
+    (device and inode) or when its first head_size bytes changed, e.g. after a rotation or a copy.
+    """
+    head_size = 4096
+
+    def __init__(self, directory, checkpoint_path=None, prefix='hycdx_option_quotes_', suffix='.txt'):
+        self.directory = directory
+        self.checkpoint_path = checkpoint_path
+        self.prefix = prefix
+        self.suffix = suffix
+        self.files = {}  # file name -> [offset, parent_quotes, [st_dev, st_ino], [head size, head sha256]]
+        self._changed = False  # whether an offset moved since the last checkpoint
+        self.latencies = deque(maxlen=1000)  # seconds from the last write of a file to its quotes being emitted
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint_path, 'r') as file:
+            checkpoint = json.load(file)
+        for name, state in checkpoint.items():
+            parent_quotes = [_option_quote_from_json(
+                fields) for fields in state['parent_quotes']]
+            # checkpoints written before the identity was recorded trust the offset
+            self.files[name] = [state['offset'], parent_quotes,
+                                state.get('identity'), state.get('head')]
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path or not self._changed:
+            return
+        checkpoint = {name: {'offset': offset, 'parent_quotes': [_option_quote_to_json(quote) for quote in parent_quotes],
+                             'identity': identity, 'head': head}
+                      for name, (offset, parent_quotes, identity, head) in self.files.items()}
+        # write to a temporary file first so that a crash never leaves a partial checkpoint
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self._changed = False
+
+    def poll(self):
+        """Parse the complete lines appended to the files since the last poll"""
+        price_quotes = QuoteColumns()
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(self.prefix) and name.endswith(self.suffix)):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            identity = [stat.st_dev, stat.st_ino]
+            state = self.files.get(name)
+            with open(path, 'rb') as file:
+                if state is not None and state[3] is not None:
+                    head = hashlib.sha256(file.read(state[3][0])).hexdigest()
+                if state is None or stat.st_size < state[0] or state[2] not in (None, identity) or \
+                        (state[3] is not None and head != state[3][1]):
+                    # a new file, or a file that was truncated, rotated or replaced
+                    state = self.files[name] = [0, [None, None], identity, None]
+                    self._changed = True
+                if state[2] is None:
+                    state[2] = identity
+                    self._changed = True
+                if stat.st_size == state[0]:
+                    continue
+                file.seek(state[0])
+                data = file.read(stat.st_size - state[0])
+            # leave a partially written last line for the next poll
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                continue
+            count = len(price_quotes)
+            process_option_quote_text(
+                _decode(data[:end]), state[1], price_quotes)
+            state[0] += end
+            if state[3] is None or state[3][0] < min(state[0], self.head_size):
+                # the head grows with what was parsed until it is head_size bytes long
+                with open(path, 'rb') as file:
+                    size = min(state[0], self.head_size)
+                    state[3] = [size, hashlib.sha256(file.read(size)).hexdigest()]
+            self._changed = True
+            if len(price_quotes) > count:
+                self.latencies.append(time.time() - stat.st_mtime)
+        return price_quotes
+
+    def follow(self, interval=0.5):
+        """Generate a QuoteColumns for every poll that found new quotes"""
+        while True:
+            started = time.monotonic()
+            price_quotes = self.poll()
+            if len(price_quotes) > 0:
+                yield price_quotes
+            # the batch was handed over, its quotes must not be emitted again after a restart
+            self.save_checkpoint()
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def run(self, callback, interval=0.5):
+        for price_quotes in self.follow(interval):
+            callback(price_quotes)
+
+
+class BookLevel:
+    """The latest quote of every firm for one (expiration, option type, strike) and the best bid and ask among them"""
+    __slots__ = ('expiration', 'option_type', 'strike_px',
+                 'quotes', 'best_bid', 'best_ask')
+
+    def __init__(self, expiration, option_type, strike_px):
+        self.expiration = expiration
+        self.option_type = option_type
+        self.strike_px = strike_px
+        self.quotes = {}  # firm -> (OptionQuote, bid, ask) with the prices re-expressed against the book's ref px
+        self.best_bid = (nan, None)  # (price, firm)
+        self.best_ask = (nan, None)
+
+    def _update_best(self, firm, bid, ask):
+        # a better price replaces the best one at once, only a firm that was the best and got worse needs a scan
+        if self.best_bid[1] == firm and not bid >= self.best_bid[0]:
+            self.best_bid = max(((quote[1], name) for name, quote in self.quotes.items() if not isnan(quote[1])),
+                                default=(nan, None))
+        elif bid > self.best_bid[0] or (isnan(self.best_bid[0]) and not isnan(bid)):
+            self.best_bid = (bid, firm)
+        if self.best_ask[1] == firm and not ask <= self.best_ask[0]:
+            self.best_ask = min(((quote[2], name) for name, quote in self.quotes.items() if not isnan(quote[2])),
+                                default=(nan, None))
+        elif ask < self.best_ask[0] or (isnan(self.best_ask[0]) and not isnan(ask)):
+            self.best_ask = (ask, firm)
+
+
+class QuoteBook:
+    """The latest quote of every firm by (expiration, option type, strike), across all the brokers
+
+    A quote replaces the one of the same firm for the same option unless it is older (by date and time).
+    With a ref_px, the bid and ask of every quote are re-expressed against it with the broker's delta:
+    price + delta * (ref_px - quote ref px), the delta being taken as positive for calls and negative
+    for puts since the brokers do not sign it the same way. Quotes that cannot be re-expressed keep NaN
+    prices. Without a ref_px the prices are kept as quoted.
+    """
+
+    def __init__(self, ref_px=None):
+        self.ref_px = ref_px
+        self.levels = {}  # (expiration, option type, strike px) -> BookLevel
+        self._strikes = {}  # (expiration, option type) -> sorted strike pxs
+
+    def __len__(self):
+        return len(self.levels)
+
+    def _prices(self, quote: OptionQuote):
+        bid = nan if quote.bid_px is None else quote.bid_px
+        ask = nan if quote.ask_px is None else quote.ask_px
+        if self.ref_px is None:
+            return bid, ask
+        if quote.delta is None or quote.ref_px is None:
+            return nan, nan
+        delta = abs(quote.delta) / 100
+        if quote.option_type == OptionType.Put:
+            delta = -delta
+        shift = delta * (self.ref_px - quote.ref_px)
+        return bid + shift, ask + shift
+
+    def insert(self, quote: OptionQuote):
+        """Add a quote to the book, return False if the firm already has a newer quote for the option"""
+        if quote.strike_px is None:
+            # the empty side of a put only row
+            return False
+        key = (quote.expiration, quote.option_type, quote.strike_px)
+        level = self.levels.get(key)
+        if level is None:
+            level = self.levels[key] = BookLevel(*key)
+            strikes = self._strikes.setdefault(key[:2], [])
+            strikes.insert(bisect_left(strikes, quote.strike_px), quote.strike_px)
+        previous = level.quotes.get(quote.firm)
+        if previous is not None and (previous[0].date, previous[0].time) > (quote.date, quote.time):
+            return False
+        bid, ask = self._prices(quote)
+        level.quotes[quote.firm] = (quote, bid, ask)
+        level._update_best(quote.firm, bid, ask)
+        return True
+
+    def update(self, price_quotes: QuoteColumns):
+        """Insert all the quotes parsed into a QuoteColumns, e.g. a batch of QuoteStream.follow()"""
+        arrays = price_quotes.to_arrays()
+        # only the latest quote of every firm and option can stay in the book, skip building the others
+        order = np.argsort(arrays['timestamp'], kind='stable')
+        keys = pd.DataFrame({name: arrays[name][order] for name in
+                             ('firm', 'expiration', 'option_type', 'strike_px')})
+        rows = order[~keys.duplicated(keep='last').to_numpy()]
+        for quote in price_quotes.to_option_quotes(rows.tolist()):
+            self.insert(quote)
+
+    def rebase(self, ref_px):
+        """Re-express the whole book against another ref px (None for the prices as quoted)"""
+        self.ref_px = ref_px
+        for level in self.levels.values():
+            quotes = level.quotes
+            level.quotes = {}
+            level.best_bid = level.best_ask = (nan, None)
+            for firm, (quote, _, _) in quotes.items():
+                bid, ask = self._prices(quote)
+                level.quotes[firm] = (quote, bid, ask)
+                level._update_best(firm, bid, ask)
+
+    def level(self, expiration, option_type, strike_px):
+        """Return the BookLevel of one option, or None"""
+        return self.levels.get((expiration, option_type, strike_px))
+
+    def strikes(self, expiration, option_type, low=-inf, high=inf):
+        """Return the BookLevels of an expiry and option type with low <= strike <= high, by strike"""
+        strikes = self._strikes.get((expiration, option_type), [])
+        return [self.levels[(expiration, option_type, strike)]
+                for strike in strikes[bisect_left(strikes, low):bisect_right(strikes, high)]]
+
+    def expirations(self):
+        return sorted({expiration for expiration, _ in self._strikes})
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used to parse the files')
+    parser.add_argument('--output-format', choices=['excel'] + list(OUTPUT_WRITERS), default='excel',
+                        help='excel writes task1_output_actual.xlsx, the others append to --output-dir')
+    parser.add_argument('--output-dir', default='task1_output',
+                        help='directory of the partitioned dataset')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep watching the directory and print the quotes of new messages')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between two polls of the directory in --follow mode')
+    parser.add_argument('--checkpoint', default='task1_checkpoint.json',
+                        help='file with the offsets already parsed in --follow mode')
+    parser.add_argument('--stats', metavar='PATH',
+                        help='count the lines matched per firm and line kind and dump the counters as JSON to PATH')
+    args = parser.parse_args()
     directory = os.getcwd()
-    price_quotes = []
     print('The current direcotry is: ' + directory)
-    for file in os.listdir(directory):
-        if file.startswith('hycdx_option_quotes_') and file.endswith('.txt'):
-            print('Reading file: ' + file)
-            with open(file, 'r') as file:
-                line = file.readline()
-                company_quote = None
-                contract_quote = None
-                parent_quotes = [company_quote, contract_quote]
-                while line:
-                    process_option_quote(line, parent_quotes, price_quotes)
-                    line = file.readline()
-    if len(price_quotes) > 0:
-        df = convert_to_dataframe(price_quotes)  # pip install pandas
-        df.to_excel('task1_output_actual.xlsx',
-                    index=False)  # pip install openpyxl
-        print('Successfully converted to excel file.')
+    stats = enable_stats() if args.stats else None
+    if args.follow:
+        stream = QuoteStream(directory, args.checkpoint)
+
+        def print_quotes(price_quotes):
+            print(convert_to_dataframe(price_quotes).to_string(index=False))
+            print('Latency: {:.3f}s (max {:.3f}s)'.format(
+                stream.latencies[-1], max(stream.latencies)))
+            if stats is not None:
+                stats.dump(args.stats)
+        stream.run(print_quotes, args.interval)
+    else:
+        paths = []
+        for file in sorted(os.listdir(directory)):
+            if file.startswith('hycdx_option_quotes_') and file.endswith('.txt'):
+                print('Reading file: ' + file)
+                paths.append(file)
+        price_quotes = parse_files(paths, workers=args.workers)
+        if len(price_quotes) > 0:
+            df = convert_to_dataframe(price_quotes)  # pip install pandas
+            if args.output_format == 'excel':
+                write_excel(df, 'task1_output_actual.xlsx')
+                print('Successfully converted to excel file.')
+            else:
+                rows = write_partitioned(
+                    df, args.output_dir, args.output_format)
+                print('Appended {} rows to {}.'.format(rows, args.output_dir))
+        if stats is not None:
+            stats.dump(args.stats)
+            print('Wrote parse statistics to {}.'.format(args.stats))
@@ -1 +1,371 @@
-#todo
\ No newline at end of file
+import os
+import re
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from bisect import insort, bisect_left
+from functools import lru_cache
+
+
+INDEX_TICKER = 'SPY US Equity'
+
+
+def _resample_last(prices, rule):
+    # the last available price of every period, labelled with the period end
+    return prices.resample(rule).last()
+
+
+def _resample_biweekly(prices):
+    # every other weekly close, counted back from the last one so that the as of week is always kept
+    weekly = _resample_last(prices, 'W-FRI')
+    return weekly.iloc[(len(weekly) - 1) % 2::2]
+
+
+# observation frequency -> function that picks the observed prices out of the daily prices
+FREQUENCIES = {
+    'daily': lambda prices: prices,
+    'weekly': lambda prices: _resample_last(prices, 'W-FRI'),
+    'bi-weekly': _resample_biweekly,
+    'monthly': lambda prices: _resample_last(prices, 'ME'),
+    'quarterly': lambda prices: _resample_last(prices, 'QE'),
+}
+
+_window_units = {'d': 'days', 'w': 'weeks', 'm': 'months', 'y': 'years'}
+_reg_window = re.compile(r'^\s*(\d+)\s*([dwmy])\s*$', re.IGNORECASE)
+
+
+def read_stock_data(path='task2_stock_data.xlsx'):
+    """Read the daily prices, one column per ticker, indexed by date"""
+    prices = pd.read_excel(path, index_col='date')  # pip install openpyxl
+    return prices.sort_index().astype(float)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_stock_data(path='task2_stock_data.xlsx', cache_directory=None):
+    """Same as read_stock_data, from a binary copy of the workbook once it has been read
+
+    The prices are cached as .npy arrays with a ticker index in cache_directory (by default
+    the workbook path + '.cache'). The cache is rebuilt when the workbook's size and modification
+    time changed and its SHA-256 no longer matches either.
+    """
+    cache_directory = cache_directory or path + '.cache'
+    source_path = os.path.join(cache_directory, 'source.json')
+    stat = os.stat(path)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    cached = None
+    if os.path.exists(source_path):
+        with open(source_path, 'r') as file:
+            cached = json.load(file)
+    if cached is not None and (cached['size'], cached['mtime_ns']) != (source['size'], source['mtime_ns']):
+        # touched or copied, the content may still be the same
+        source['sha256'] = _file_hash(path)
+        if source['sha256'] != cached['sha256']:
+            cached = None
+        else:
+            with open(source_path + '.tmp', 'w') as file:
+                json.dump(source, file)
+            os.replace(source_path + '.tmp', source_path)
+    if cached is None:
+        prices = read_stock_data(path)
+        os.makedirs(cache_directory, exist_ok=True)
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        np.save(os.path.join(cache_directory, 'prices.npy'), prices.to_numpy())
+        np.save(os.path.join(cache_directory, 'dates.npy'), prices.index.to_numpy())
+        with open(os.path.join(cache_directory, 'tickers.json'), 'w') as file:
+            json.dump(list(prices.columns), file)
+        source['sha256'] = source.get('sha256') or _file_hash(path)
+        # source.json is written last, the cache is only used once all of it is complete
+        with open(source_path + '.tmp', 'w') as file:
+            json.dump(source, file)
+        os.replace(source_path + '.tmp', source_path)
+        return prices
+    with open(os.path.join(cache_directory, 'tickers.json'), 'r') as file:
+        tickers = json.load(file)
+    values = np.load(os.path.join(cache_directory, 'prices.npy'), mmap_mode='r')
+    dates = np.load(os.path.join(cache_directory, 'dates.npy'))
+    # copy=False keeps the frame on the memory-mapped file
+    return pd.DataFrame(values, index=pd.DatetimeIndex(dates, name='date'), columns=tickers, copy=False)
+
+
+def window_start(as_of_date, window):
+    """The first date of a window such as '1y', '6m', '13w' or '90d' ending on as_of_date"""
+    matched = _reg_window.match(window)
+    if not matched:
+        raise ValueError('Unknown beta calculation window: ' + window)
+    offset = pd.DateOffset(
+        **{_window_units[matched.group(2).lower()]: int(matched.group(1))})
+    return pd.Timestamp(as_of_date) - offset
+
+
+def observed_prices(prices, as_of_date, window='1y', frequency='weekly'):
+    """The prices of the window observed at the given frequency"""
+    if frequency not in FREQUENCIES:
+        raise ValueError('Unknown observation frequency: ' + frequency)
+    as_of_date = pd.Timestamp(as_of_date)
+    prices = prices.loc[window_start(as_of_date, window):as_of_date]
+    return FREQUENCIES[frequency](prices)
+
+
+def compute_returns(prices):
+    """Simple returns of every column at once, NaN where either price is missing
+
+    A return from a price of zero (a delisted warrant) is not finite and is treated as missing too.
+    """
+    values = np.asarray(prices, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns = values[1:] / values[:-1] - 1.0
+    returns[~np.isfinite(returns)] = np.nan
+    return returns
+
+
+def winsorize(returns, limits=(0.05, 0.05)):
+    """Clip every column to its own percentiles
+
+    Same as scipy.stats.mstats.winsorize(column, limits) on the non-NaN values of each column,
+    with all the columns sorted in one pass. NaN stays NaN.
+    """
+    ordered = np.sort(returns, axis=0)  # NaN sorts last, so the valid values come first
+    counts = np.count_nonzero(~np.isnan(returns), axis=0)
+    low = (limits[0] * counts).astype(int)
+    high = np.maximum(counts - (limits[1] * counts).astype(int) - 1, 0)
+    lower = np.take_along_axis(ordered, low[np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(ordered, high[np.newaxis], axis=0)[0]
+    return np.clip(returns, lower, upper)
+
+
+def compute_betas(returns, index_returns, min_observations=2):
+    """cov(returns, index) / var(index) of every column at once
+
+    Each column only uses the periods where both it and the index have a return, so a ticker with a
+    late start (a SPAC unit, a warrant) gets the beta of the history it has. The beta is NaN with fewer
+    than min_observations such periods.
+    """
+    valid = ~np.isnan(returns) & ~np.isnan(index_returns)[:, np.newaxis]
+    counts = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.where(valid, index_returns[:, np.newaxis], 0.0)
+        y = np.where(valid, returns, 0.0)
+        x_mean = x.sum(axis=0) / counts
+        y_mean = y.sum(axis=0) / counts
+        x = np.where(valid, x - x_mean, 0.0)
+        y = np.where(valid, y - y_mean, 0.0)
+        betas = (x * y).sum(axis=0) / (x * x).sum(axis=0)
+    betas[counts < min_observations] = np.nan
+    return betas
+
+
+def calculate_betas(prices, as_of_date, window='1y', frequency='weekly', index_ticker=INDEX_TICKER,
+                    limits=(0.05, 0.05)):
+    """Return {ticker: beta against the index} from winsorized returns of the window"""
+    observed = observed_prices(prices, as_of_date, window, frequency)
+    returns = winsorize(compute_returns(observed), limits)
+    index_column = observed.columns.get_loc(index_ticker)
+    betas = compute_betas(returns, returns[:, index_column])
+    return {ticker: float(beta) for ticker, beta in zip(observed.columns, betas) if ticker != index_ticker}
+
+
+class BetaCalculator:
+    """calculate_betas on one price matrix, with the winsorized returns of recent requests kept in memory
+
+    The returns are cached by (frequency, window, as of date) in an LRU cache of cache_size entries,
+    so the scenarios that share them (e.g. the same returns against another index) are not resampled again.
+    """
+
+    def __init__(self, prices, index_ticker=INDEX_TICKER, limits=(0.05, 0.05), cache_size=256):
+        self.prices = prices
+        self.index_ticker = index_ticker
+        self.limits = limits
+        self.returns = lru_cache(maxsize=cache_size)(self._returns)
+
+    def _returns(self, frequency, window, as_of_date):
+        observed = observed_prices(self.prices, as_of_date, window, frequency)
+        returns = winsorize(compute_returns(observed), self.limits)
+        # shared by every caller that hits the cache
+        returns.flags.writeable = False
+        return returns
+
+    def _betas(self, as_of_date, window, frequency):
+        returns = self.returns(frequency, window, pd.Timestamp(as_of_date))
+        return compute_betas(returns, returns[:, self.prices.columns.get_loc(self.index_ticker)])
+
+    def betas(self, as_of_date, window='1y', frequency='weekly'):
+        """Same as calculate_betas(prices, as_of_date, window, frequency)"""
+        betas = self._betas(as_of_date, window, frequency)
+        return {ticker: float(beta) for ticker, beta in zip(self.prices.columns, betas) if ticker != self.index_ticker}
+
+    def grid(self, as_of_dates, frequencies=tuple(FREQUENCIES), windows=('1y',)):
+        """Return the betas of every scenario, one row per (as of date, window, frequency) and one column per ticker"""
+        scenarios = [(pd.Timestamp(as_of_date), window, frequency)
+                     for as_of_date in as_of_dates for window in windows for frequency in frequencies]
+        betas = np.array([self._betas(*scenario) for scenario in scenarios])
+        index = pd.MultiIndex.from_tuples(
+            scenarios, names=['as_of_date', 'window', 'frequency'])
+        betas = pd.DataFrame(betas.reshape(len(scenarios), len(self.prices.columns)),
+                             index=index, columns=self.prices.columns)
+        return betas.drop(columns=self.index_ticker)
+
+
+class _SortedWindow:
+    """The valid returns of every column in a sliding window, kept sorted as rows enter and leave it
+
+    Every column is a list of (value, row) sorted with bisect.insort, so a row is inserted and removed
+    with one shift of that column's list from its position on, and the winsorization bounds are read
+    off the order statistics instead of sorting the window again.
+    """
+
+    def __init__(self, columns):
+        self.columns = [[] for _ in range(columns)]
+
+    def add(self, row, values):
+        for column in np.flatnonzero(~np.isnan(values)).tolist():
+            insort(self.columns[column], (values[column], row))
+
+    def remove(self, row, values):
+        for column in np.flatnonzero(~np.isnan(values)).tolist():
+            entries = self.columns[column]
+            # the row breaks the ties between equal values, so this is the entry of the row
+            del entries[bisect_left(entries, (values[column], row))]
+
+    def tails(self, limits):
+        """Return the winsorization bounds of every column and the rows of the values clipped to them
+
+        The rows are a (2 * tail size, columns) array of which only the slots where mask is True are tails.
+        """
+        counts = np.array([len(entries) for entries in self.columns])
+        low = (limits[0] * counts).astype(int)
+        high = (limits[1] * counts).astype(int)
+        size = max(low.max(), high.max(), 1)
+        lower = np.full(len(self.columns), np.nan)
+        upper = np.full(len(self.columns), np.nan)
+        rows = np.full((2 * size, len(self.columns)), -1)
+        for column, (entries, low_count, high_count) in enumerate(zip(self.columns, low.tolist(), high.tolist())):
+            if not entries:
+                continue
+            count = len(entries)
+            lower[column] = entries[min(low_count, count - 1)][0]
+            upper[column] = entries[max(count - high_count - 1, 0)][0]
+            rows[:low_count, column] = [entry[1] for entry in entries[:low_count]]
+            # the high tail from the largest value down
+            rows[size:size + high_count, column] = [entry[1] for entry in entries[count - high_count:][::-1]]
+        slots = np.arange(size)[:, np.newaxis]
+        mask = np.concatenate([slots < low, slots < high])
+        return lower, upper, rows, mask
+
+
+def rolling_betas(prices, window='1y', frequency='daily', index_ticker=INDEX_TICKER,
+                  limits=(0.05, 0.05), min_observations=2, start=None):
+    """Return a DataFrame of the betas of every ticker (columns) as of every observation date (rows)
+
+    The result as of each date is the same as calculate_betas(prices, date, window, frequency).
+    The window slides one observation at a time: the running sums of x, y, xy and x^2 of the raw returns
+    are updated with the returns that enter and leave it, and the effect of the winsorization is added
+    from the few returns in the tails only. The first as of date is start, by default the first date
+    with a full window of history.
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError('Unknown observation frequency: ' + frequency)
+    observed = FREQUENCIES[frequency](prices)
+    dates = observed.index
+    returns = compute_returns(observed)  # return i is from dates[i] to dates[i + 1]
+    index_column = observed.columns.get_loc(index_ticker)
+    index_returns = returns[:, index_column]
+    # an observation is in a window when the last trading day of its period is, and not its label
+    trading_days = FREQUENCIES[frequency](pd.DataFrame({'day': prices.index}, index=prices.index))
+    trading_days = pd.DatetimeIndex(trading_days['day'].ffill())
+    # the returns in the window as of dates[t] are returns[firsts[t]:t]
+    firsts = trading_days.searchsorted([window_start(date, window) for date in dates])
+    if start is None:
+        first_as_of = int(np.argmax(firsts > 0)) if firsts[-1] > 0 else len(dates)
+    else:
+        first_as_of = dates.searchsorted(pd.Timestamp(start))
+    columns = len(observed.columns)
+    sorted_window = _SortedWindow(columns)
+    # running sums over the returns where both the ticker and the index have a value
+    counts = np.zeros(columns)
+    sum_x, sum_y, sum_xy, sum_xx = (np.zeros(columns) for _ in range(4))
+
+    def update(row, sign):
+        x, y = index_returns[row], returns[row]
+        valid = ~np.isnan(y) & ~np.isnan(x)
+        x = np.where(valid, x, 0.0)
+        y = np.where(valid, y, 0.0)
+        counts[:] += sign * valid
+        sum_x[:] += sign * x
+        sum_y[:] += sign * y
+        sum_xy[:] += sign * x * y
+        sum_xx[:] += sign * x * x
+
+    betas = np.full((len(dates) - first_as_of, columns), np.nan)
+    window_first, window_end = 0, 0
+    for t in range(first_as_of, len(dates)):
+        while window_end < t:
+            sorted_window.add(window_end, returns[window_end])
+            update(window_end, 1)
+            window_end += 1
+        while window_first < firsts[t]:
+            sorted_window.remove(window_first, returns[window_first])
+            update(window_first, -1)
+            window_first += 1
+        lower, upper, rows, mask = sorted_window.tails(limits)
+
+        # winsorized x = x + dx where dx is non-zero only in the tails of the index
+        x_rows = rows[mask[:, index_column], index_column]
+        x = index_returns[x_rows]
+        dx = np.clip(x, lower[index_column], upper[index_column]) - x
+        y = returns[x_rows]
+        y_valid = ~np.isnan(y)
+        corrected_x = sum_x + np.where(y_valid, dx[:, np.newaxis], 0.0).sum(axis=0)
+        corrected_xx = sum_xx + np.where(y_valid, (2 * x * dx + dx * dx)[:, np.newaxis], 0.0).sum(axis=0)
+        corrected_xy = sum_xy + np.where(y_valid, dx[:, np.newaxis] * y, 0.0).sum(axis=0)
+
+        # winsorized y = y + dy where dy is non-zero only in the tails of each ticker
+        y = returns[rows, np.arange(columns)]
+        x = index_returns[rows]
+        valid = mask & ~np.isnan(x)
+        dy = np.where(valid, np.clip(y, lower, upper) - y, 0.0)
+        winsorized_x = np.where(valid, np.clip(x, lower[index_column], upper[index_column]), 0.0)
+        corrected_y = sum_y + dy.sum(axis=0)
+        # sum((x + dx) * (y + dy)) = sum(xy) + sum(dx * y) + sum(dy * (x + dx))
+        corrected_xy += (dy * winsorized_x).sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = corrected_xy - corrected_x * corrected_y / counts
+            variance = corrected_xx - corrected_x * corrected_x / counts
+            beta = covariance / variance
+        # a constant index return has a variance of rounding errors only, its beta is undefined
+        beta[(counts < min_observations) | (variance <= 1e-12 * corrected_xx)] = np.nan
+        betas[t - first_as_of] = beta
+    betas = pd.DataFrame(betas, index=dates[first_as_of:], columns=observed.columns)
+    return betas.drop(columns=index_ticker)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--as-of', nargs='+', default=['2021-10-31'], help='as of dates')
+    parser.add_argument('--window', nargs='+', default=['1y'],
+                        help='beta calculation windows, e.g. 1y, 6m, 13w or 90d')
+    parser.add_argument('--frequency', nargs='+', choices=list(FREQUENCIES), default=['daily', 'weekly'],
+                        help='observation frequencies of the returns')
+    parser.add_argument('--rolling', action='store_true',
+                        help='also write the betas as of every date to task2_rolling_betas_<window>_<frequency>.csv')
+    args = parser.parse_args()
+    prices = load_stock_data()
+    betas = BetaCalculator(prices).grid(args.as_of, args.frequency, args.window).T
+    print('Betas against {}'.format(INDEX_TICKER))
+    print(betas.to_string())
+    if args.rolling:
+        for window in args.window:
+            for frequency in args.frequency:
+                path = 'task2_rolling_betas_{}_{}.csv'.format(window, frequency)
+                rolling_betas(prices, window, frequency).to_csv(path)
+                print('Successfully wrote ' + path)